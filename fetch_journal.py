@@ -0,0 +1,235 @@
+""" Persistent journal of the fetching work so that an interrupted fetch can be resumed."""
+import json
+import typing
+import sqlite3
+from pathlib import Path
+from datetime import datetime, timezone
+from url import URL
+
+
+class FetchJournal:
+    """ SQLite backed journal of every unit of work of a fetch run.
+        A unit is either a page of challenges, the registrant list of a challenge or a member,
+        its state goes from `planned` to `done`, or `failed` until it's fetched in a later round.
+        A metadata window whose attempts all failed is recorded as a `failed` unit as well, it's fetched again
+        (and its pages planned) by a resumed run.
+    """
+    filename = 'fetch_journal.sqlite3'
+
+    @staticmethod
+    def challenge_key(year: int, page: int) -> str:
+        return f'challenge:{year}:{page}'
+
+    @staticmethod
+    def registrant_key(challenge_id: str) -> str:
+        return f'registrant:{challenge_id}'
+
+    @staticmethod
+    def member_key(handle_lower: str) -> str:
+        return f'member:{handle_lower}'
+
+    @staticmethod
+    def window_key(url: URL) -> str:
+        return f'window:{url}'
+
+    def __init__(self, output_dir: Path) -> None:
+        self.path = output_dir / self.filename
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                """ CREATE TABLE IF NOT EXISTS unit (
+                        key TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        year INTEGER NOT NULL,
+                        page INTEGER NOT NULL,
+                        challenge_id TEXT,
+                        url TEXT NOT NULL,
+                        state TEXT NOT NULL,
+                        updated_at TEXT NOT NULL
+                    )
+                """
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS run_param (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS watermark (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def reset(self, **run_param) -> None:
+        """ Forget the units of the previous run and record the parameters of the new one."""
+        with self.conn:
+            self.conn.execute('DELETE FROM unit')
+            self.conn.execute('DELETE FROM run_param')
+            self.conn.executemany(
+                'INSERT INTO run_param (key, value) VALUES (?, ?)',
+                [(key, json.dumps(value, default=str)) for key, value in run_param.items()],
+            )
+
+    def run_param(self) -> dict:
+        return {key: json.loads(value) for key, value in self.conn.execute('SELECT key, value FROM run_param')}
+
+    def watermark(self, key: str) -> typing.Optional[datetime]:
+        """ High-water mark for the `updatedDateStart` filter, it survives `reset` on purpose."""
+        row = self.conn.execute('SELECT value FROM watermark WHERE key = ?', (key,)).fetchone()
+        return row and datetime.fromisoformat(row[0])
+
+    def set_watermark(self, keys: list[str], value: datetime) -> None:
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO watermark (key, value) VALUES (?, ?)',
+                [(key, value.isoformat()) for key in keys],
+            )
+
+    def has_unit(self, kind: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM unit WHERE kind = ? LIMIT 1', (kind,)).fetchone() is not None
+
+    def count_unfinished(self) -> int:
+        """ Number of units of any kind not done, the run is complete if there is none."""
+        return self.conn.execute("SELECT COUNT(*) FROM unit WHERE state != 'done'").fetchone()[0]
+
+    def fail_window(self, year: int, url: URL) -> None:
+        with self.conn:
+            self.conn.execute(
+                """ INSERT OR REPLACE INTO unit (key, kind, year, page, url, state, updated_at)
+                    VALUES (?, 'window', ?, 0, ?, 'failed', ?)
+                """,
+                (self.window_key(url), year, str(url), self.now()),
+            )
+
+    def complete_window(self, url: URL) -> None:
+        """ Only a window that failed before is in the journal."""
+        with self.conn:
+            self.update_state(self.window_key(url), 'done')
+
+    def failed_windows(self) -> list[tuple[int, URL]]:
+        """ Year and url of the metadata windows whose attempts all failed."""
+        return [
+            (year, URL(url)) for year, url in self.conn.execute(
+                "SELECT year, url FROM unit WHERE kind = 'window' AND state = 'failed' ORDER BY year, key"
+            )
+        ]
+
+    def last_pages(self) -> dict[int, int]:
+        """ Last planned challenge page of every year."""
+        return dict(self.conn.execute("SELECT year, MAX(page) FROM unit WHERE kind = 'challenge' GROUP BY year"))
+
+    def plan_challenges(self, challenge_params: list[tuple[int, URL, int]]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                """ INSERT OR IGNORE INTO unit (key, kind, year, page, url, state, updated_at)
+                    VALUES (?, 'challenge', ?, ?, ?, 'planned', ?)
+                """,
+                [
+                    (self.challenge_key(year, page), year, page, str(url), self.now())
+                    for year, url, page in challenge_params
+                ],
+            )
+
+    def complete_challenge(self, year: int, page: int) -> None:
+        with self.conn:
+            self.update_state(self.challenge_key(year, page), 'done')
+
+    def plan_registrants(self, registrant_params: list[tuple[int, int, str, URL]]) -> None:
+        """ Plan the registrant lists discovered in a challenge page, they are fetched before the page is written."""
+        with self.conn:
+            self.conn.executemany(
+                """ INSERT OR IGNORE INTO unit (key, kind, year, page, challenge_id, url, state, updated_at)
+                    VALUES (?, 'registrant', ?, ?, ?, ?, 'planned', ?)
+                """,
+                [
+                    (self.registrant_key(challenge_id), reg_year, reg_page, challenge_id, str(url), self.now())
+                    for reg_year, reg_page, challenge_id, url in registrant_params
+                ],
+            )
+
+    def fail_challenge(self, year: int, page: int) -> None:
+        with self.conn:
+            self.update_state(self.challenge_key(year, page), 'failed')
+
+    def complete_registrant(self, challenge_id: str) -> None:
+        with self.conn:
+            self.update_state(self.registrant_key(challenge_id), 'done')
+
+    def done_registrants(self, challenge_ids: list[str]) -> set[str]:
+        """ The challenges among `challenge_ids` whose registrant list is done."""
+        done = set()
+        for idx in range(0, len(challenge_ids), 500):  # SQLite limits the number of host parameters in a statement
+            chunk = challenge_ids[idx: idx + 500]
+            done.update(
+                challenge_id for challenge_id, in self.conn.execute(
+                    """ SELECT challenge_id FROM unit
+                        WHERE kind = 'registrant' AND state = 'done' AND challenge_id IN ({})
+                    """.format(', '.join('?' * len(chunk))),
+                    chunk,
+                )
+            )
+
+        return done
+
+    def fail_registrant(self, challenge_id: str) -> None:
+        with self.conn:
+            self.update_state(self.registrant_key(challenge_id), 'failed')
+
+    def plan_members(self, member_params: list[tuple[int, int, str, URL]]) -> None:
+        """ Plan the members of a registrant list, a member registered in many challenges is only planned once."""
+        with self.conn:
+            self.conn.executemany(
+                """ INSERT OR IGNORE INTO unit (key, kind, year, page, url, state, updated_at)
+                    VALUES (?, 'member', ?, ?, ?, 'planned', ?)
+                """,
+                [
+                    (self.member_key(handle_lower), year, page, str(url), self.now())
+                    for year, page, handle_lower, url in member_params
+                ],
+            )
+
+    def complete_members(self, handles_lower: list[str]) -> None:
+        with self.conn:
+            for handle_lower in handles_lower:
+                self.update_state(self.member_key(handle_lower), 'done')
+
+    def fail_member(self, handle_lower: str) -> None:
+        with self.conn:
+            self.update_state(self.member_key(handle_lower), 'failed')
+
+    def pending_challenges(self) -> list[tuple[int, URL, int]]:
+        """ Challenge pages not fetched yet, in the same shape as `Fetcher.construct_fetch_challenge_param`."""
+        return [
+            (year, URL(url), page) for year, page, url in self.conn.execute(
+                "SELECT year, page, url FROM unit WHERE kind = 'challenge' AND state != 'done' ORDER BY year, page"
+            )
+        ]
+
+    def pending_registrants(self) -> list[tuple[int, int, str, URL]]:
+        """ Registrant lists not fetched yet, in the same shape as `Fetcher.construct_registrant_param`."""
+        return [
+            (year, page, challenge_id, URL(url)) for year, page, challenge_id, url in self.conn.execute(
+                """ SELECT year, page, challenge_id, url FROM unit
+                    WHERE kind = 'registrant' AND state != 'done' ORDER BY year, page
+                """
+            )
+        ]
+
+    def pending_members(self) -> list[tuple[str, URL]]:
+        """ Lower cased handle and url of the members not fetched yet."""
+        return [
+            (key[len(self.member_key('')):], URL(url)) for key, url in self.conn.execute(
+                "SELECT key, url FROM unit WHERE kind = 'member' AND state != 'done' ORDER BY key"
+            )
+        ]
+
+    def members(self) -> list[str]:
+        """ Lower cased handle of all the members of the run."""
+        return [
+            key[len(self.member_key('')):]
+            for key, in self.conn.execute("SELECT key FROM unit WHERE kind = 'member' ORDER BY key")
+        ]
+
+    def update_state(self, key: str, state: str) -> None:
+        self.conn.execute('UPDATE unit SET state = ?, updated_at = ? WHERE key = ?', (state, self.now(), key))
+
+    @staticmethod
+    def now() -> str:
+        return datetime.now(timezone.utc).isoformat()
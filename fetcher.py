@@ -1,20 +1,222 @@
 """ Topcoder data collector using http://api.topcoder.com/v5"""
-import re
 import json
+import time
+import typing
 import logging
 import asyncio
 import aiohttp
+import contextlib
 from pathlib import Path
 from collections import defaultdict
-from datetime import datetime, timezone
-from util import datetime_to_isoformat
-from static_var import CHALLENGE_URL, RESOURCE_URL, AUTH_TOKEN, Status
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from dateutil.parser import isoparse
+from urllib.parse import quote
+from util import KeyValueCache, datetime_to_isoformat
+from static_var import (
+    CHALLENGE_URL,
+    RESOURCE_URL,
+    MEMBER_URL,
+    AUTH_TOKEN,
+    HTTP_CONFIG,
+    PAGINATION_LIMIT,
+    HttpConfig,
+    Status,
+    Track,
+    SortBy,
+    SortOrder,
+)
 from url import URL
+from fetch_journal import FetchJournal
+from metrics import FetchMetrics, RequestRecord
+from storage import Storage, JsonFileStorage
+
+if typing.TYPE_CHECKING:
+    from topcoder_mongo import ChallengeStreamWriter
+
+
+class RequestScheduler:
+    """ Central throttle for every request sent by the Fetcher.
+        - At most `concurrency` requests are in flight at the same time.
+        - Requests are released by a token bucket refilled at `rate_limit` requests per second.
+        - A 429/5xx response or a timeout pauses the bucket (honoring `Retry-After` if presented)
+          and halves the rate, which then recovers a little on every successful request.
+    """
+    retry_status = {429, 500, 502, 503, 504}
+    base_backoff = 1.0
+
+    @staticmethod
+    def parse_retry_after(headers: typing.Optional[typing.Mapping[str, str]]) -> typing.Optional[float]:
+        """ `Retry-After` is either delay seconds or a HTTP date."""
+        value = headers and headers.get('Retry-After')
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+    def __init__(self, concurrency: int, rate_limit: float, max_backoff: float, logger: logging.Logger) -> None:
+        self.max_rate = rate_limit  # non-positive rate limit means no rate limit at all
+        self.rate = rate_limit
+        self.min_rate = rate_limit / 2 ** 5
+        self.max_backoff = max_backoff
+        self.logger = logger
+
+        # Create the primitives inside the running loop, i.e. the scheduler is instantiated in `Fetcher.fetch`
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket_lock = asyncio.Lock()
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.consecutive_failures = 0
+
+    async def wait_for_token(self) -> None:
+        """ Block until the bucket is not paused and has a token to spend."""
+        async with self.bucket_lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                if self.max_rate <= 0:
+                    return
+
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def back_off(
+        self,
+        status: typing.Optional[int],
+        headers: typing.Optional[typing.Mapping[str, str]],
+        cause: str = 'timeout',
+    ) -> None:
+        """ Pause the bucket and slow down the rate after the API pushes back, `cause` is logged without status."""
+        now = time.monotonic()
+        retry_after = self.parse_retry_after(headers)
+
+        if now < self.paused_until:  # Requests in flight failing for the same reason, don't punish twice
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + min(retry_after, self.max_backoff))
+            return
+
+        self.consecutive_failures += 1
+        delay = min(
+            self.max_backoff,
+            retry_after if retry_after is not None else self.base_backoff * 2 ** (self.consecutive_failures - 1),
+        )
+        self.paused_until = now + delay
+        self.last_refill, self.tokens = self.paused_until, 0.0
+        if self.max_rate > 0:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+        self.logger.warning(
+            'Scheduler | Status %s | Pause %.1f seconds | Rate %.2f req/s',
+            status or cause, delay, self.rate,
+        )
+
+    def recover(self) -> None:
+        """ Additive increase of the rate after a successful request."""
+        self.consecutive_failures = 0
+        if self.max_rate > 0:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    @contextlib.asynccontextmanager
+    async def throttle(self) -> typing.AsyncGenerator[None, None]:
+        """ Wrap a single request, exceptions are re-raised after being accounted."""
+        async with self.semaphore:
+            await self.wait_for_token()
+            try:
+                yield
+            except aiohttp.ClientResponseError as e:
+                if e.status in self.retry_status:
+                    self.back_off(e.status, e.headers)
+                raise
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                self.back_off(None, None)
+                raise
+            except ValueError:  # Not JSON, e.g. the error page of a proxy, it'd be requested again at full rate
+                self.back_off(None, None, 'invalid_json')
+                raise
+            else:
+                self.recover()
+
+
+class ResponseCache:
+    """ Local cache of the JSON responses of GET requests, revalidated with `If-None-Match`/`If-Modified-Since`.
+        Only responses with an `ETag` or `Last-Modified` header are cached, a 304 response is served from the cache.
+        The least recently used responses are evicted as soon as the cache grows over `max_bytes`.
+    """
+    filename = 'http_cache.sqlite3'
+
+    def __init__(self, directory: Path, max_bytes: int, logger: logging.Logger) -> None:
+        self.cache = KeyValueCache(directory / self.filename, max_bytes)
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+
+    async def get_json(
+        self,
+        session: aiohttp.ClientSession,
+        url: URL,
+        record: RequestRecord,
+        **request_kwargs,
+    ) -> typing.Any:
+        key = f'{url}'
+        cached = self.cache.get_many([key], touch=True).get(key)
+
+        headers = {}
+        if cached is not None and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached is not None and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        async with session.get(key, headers=headers, **request_kwargs) as response:
+            if response.status == 304 and cached is not None:
+                self.hits += 1
+                record.outcome = 'not_modified'
+                return cached['body']
+
+            content = await response.read()
+            record.body_bytes = len(content)
+            body = json.loads(content)
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        self.misses += 1
+        if etag or last_modified:
+            self.cache.set_many({key: {'etag': etag, 'last_modified': last_modified, 'body': body}})
+
+        return body
+
+    def close(self) -> None:
+        self.logger.info(
+            'HTTP cache | hits %d | misses %d | evicted %d entries | size %d bytes',
+            self.hits, self.misses, self.cache.evicted, self.cache.size(),
+        )
+        self.cache.close()
 
 
 class Fetcher:
     """ Data Collector."""
     auth_header = AUTH_TOKEN and {'Authorization': AUTH_TOKEN}
+    watermark_overlap = timedelta(minutes=10)  # Absorb the clock skew and the challenges updated during a fetch
+    min_window = timedelta(days=1)
+    meta_attempts = 3
+    member_cache_filename = 'member_cache.sqlite3'
 
     @staticmethod
     def construct_url_by_year(since: datetime, to: datetime) -> list[tuple[int, URL]]:
@@ -47,6 +249,25 @@ class Fetcher:
 
         return time_frame
 
+    @staticmethod
+    def bisect_url(url: URL) -> typing.Optional[tuple[URL, URL]]:
+        """ Split the end date range of a challenge search into two halves.
+            The upper half keeps the original upper bound, which could be the `startDateEnd`.
+            Return None if the range is already no longer than `min_window`.
+        """
+        lower = isoparse(url.query_param.get('endDateStart'))
+        upper = isoparse(url.query_param.get('endDateEnd') or url.query_param.get('startDateEnd'))
+        if upper - lower <= Fetcher.min_window:
+            return None
+
+        middle = lower + (upper - lower) / 2
+        middle = middle.replace(microsecond=middle.microsecond // 1000 * 1000)  # API datetime is in milliseconds
+
+        lower_half, upper_half = url.copy(), url.copy()
+        lower_half.query_param.set('endDateEnd', datetime_to_isoformat(middle))
+        upper_half.query_param.set('endDateStart', datetime_to_isoformat(middle + timedelta(milliseconds=1)))
+        return lower_half, upper_half
+
     @staticmethod
     def update_base_url(status: Status):
         """ Update challenge api URL based on command line input"""
@@ -55,6 +276,19 @@ class Fetcher:
         else:
             CHALLENGE_URL.query_param.set('status', status.value)
 
+    @staticmethod
+    def update_incremental_url(updated_since: datetime) -> None:
+        """ Only fetch the challenges updated since last fetch, oldest update first."""
+        CHALLENGE_URL.query_param.set('sortBy', SortBy.updated.value)
+        CHALLENGE_URL.query_param.set('sortOrder', SortOrder.ascending.value)
+        CHALLENGE_URL.query_param.set('updatedDateStart', datetime_to_isoformat(updated_since))
+
+    @staticmethod
+    def watermark_keys(status: str) -> list[str]:
+        """ The high-water mark is kept per status and track."""
+        tracks = CHALLENGE_URL.query_param.get_all('tracks[]') or [track.value for track in Track]
+        return [f'{status}|{track}' for track in tracks]
+
     def __init__(
         self,
         status: Status,
@@ -63,6 +297,19 @@ class Fetcher:
         with_registrant: bool,
         output_dir: Path,
         logger: logging.Logger,
+        concurrency: int = 50,
+        rate_limit: float = 20,
+        max_backoff: float = 60,
+        max_rounds: int = 10,
+        resume: bool = False,
+        incremental: bool = False,
+        stream: typing.Optional['ChallengeStreamWriter'] = None,
+        storage_factory: typing.Callable[[Path], Storage] = JsonFileStorage,
+        with_member: bool = False,
+        member_ttl: float = 30 * 24 * 3600,
+        http_cache_size: int = 512 * 2 ** 20,
+        http_config: HttpConfig = HTTP_CONFIG,
+        metrics_file: typing.Optional[Path] = None,
     ) -> None:
         self.status: str = status.value
         self.since = since
@@ -71,9 +318,52 @@ class Fetcher:
         self.output_dir = output_dir
         self.logger = logger
 
-        self.metadata = defaultdict(dict)
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.max_backoff = max_backoff
+        self.max_rounds = max_rounds  # A unit still failing after as many rounds is left failed in the journal
+        self.scheduler: typing.Optional[RequestScheduler] = None
+        self.metrics = FetchMetrics()
+        self.metrics_file = metrics_file
+
+        self.http_config = http_config
+        self.timeouts = {  # The metadata HEAD requests are tiny, the registrant lists of perPage=5000 are not
+            phase: aiohttp.ClientTimeout(total=None, sock_connect=http_config.connect_timeout, sock_read=read_timeout)
+            for phase, read_timeout in [
+                ('meta', http_config.meta_timeout),
+                ('challenge', http_config.read_timeout),
+                ('registrant', http_config.registrant_timeout),
+                ('member', http_config.read_timeout),
+            ]
+        }
+
+        self.resume = resume
+        self.journal = FetchJournal(output_dir)
+
+        self.stream = stream
+        self.registrant_tasks: set[asyncio.Task] = set()
+        self.scheduled_registrants: set[str] = set()  # Challenge id of the registrant tasks
+
+        self.with_member = with_member
+        self.member_ttl = member_ttl
+        self.member_cache = KeyValueCache(output_dir / self.member_cache_filename) if with_member else None
+
+        self.response_cache = ResponseCache(output_dir, http_cache_size, logger) if http_cache_size > 0 else None
+        self.storage_factory = storage_factory
+        self.storage: typing.Optional[Storage] = None  # Opened by `fetch` once the run is known, see `open_storage`
+
+        self.incremental = incremental
+        self.started_at = datetime.now(timezone.utc)
+        self.updated_since: typing.Optional[datetime] = None
+
+        self.metadata: defaultdict[int, list[dict]] = defaultdict(list)
 
         self.update_base_url(status)
+        if incremental:
+            watermarks = [self.journal.watermark(key) for key in self.watermark_keys(self.status)]
+            if all(watermarks):
+                self.updated_since = min(watermarks) - self.watermark_overlap
+                self.update_incremental_url(self.updated_since)
         self.url_by_year = self.construct_url_by_year(since, to)
 
         self.logger.info('Fetcher initiated')
@@ -81,93 +371,312 @@ class Fetcher:
         self.logger.info('Fetch time interval: %s - %s', since.strftime('%Y-%m-%d'), to.strftime('%Y-%m-%d'))
         self.logger.debug('since param: %s', since)
         self.logger.debug('to param: %s', to)
-
-    def construct_fetch_challenge_param(self) -> list[tuple[int, URL, int]]:
-        """ Construct the parameters for fetching the challenges from the metadata (for the first time)."""
+        self.logger.info('Fetch concurrency: %d | Rate limit: %s req/s', concurrency, rate_limit or 'unlimited')
+        self.logger.info(
+            'HTTP | Per host limit: %s | Keep-alive: %ss | DNS TTL: %ss | Compression: %s | Proxy: %s',
+            http_config.limit_per_host or 'none', http_config.keepalive_timeout, http_config.dns_ttl,
+            'on' if http_config.compression else 'off', http_config.proxy or 'none',
+        )
+        self.logger.info(
+            'HTTP timeouts | Connect: %ss | Meta: %ss | Read: %ss | Registrant: %ss',
+            http_config.connect_timeout, http_config.meta_timeout,
+            http_config.read_timeout, http_config.registrant_timeout,
+        )
+        if incremental:
+            self.logger.info('Incremental fetch | Updated since: %s', self.updated_since or 'no watermark, full fetch')
+
+    def construct_fetch_challenge_param(
+        self,
+        last_page_by_year: typing.Optional[dict[int, int]] = None,
+    ) -> list[tuple[int, URL, int]]:
+        """ Construct the parameters for fetching the challenges from the metadata (for the first time).
+            The pages of all windows in a year are numbered continuously so that the file names won't collide,
+            after `last_page_by_year` for the windows added to a resumed run.
+        """
         param = []
-        for year, metadata in self.metadata.items():
-            for page in range(1, metadata['total_pages'] + 1):
-                url: URL = metadata['url'].copy()
-                url.query_param.set('page', page)
-                param.append((year, url, page))
+        for year, windows in self.metadata.items():
+            page = (last_page_by_year or {}).get(year, 0)
+            for window in windows:
+                for window_page in range(1, window['total_pages'] + 1):
+                    page += 1
+                    url: URL = window['url'].copy()
+                    url.query_param.set('page', window_page)
+                    param.append((year, url, page))
 
         return param
 
-    def construct_registrant_param(self) -> list[tuple[int, int, str, URL]]:
-        """ Construct the parameters for fetching the challenge registrant from
-            fetched challenge (for the first time).
+    def open_storage(self) -> Storage:
+        """ The delta of an incremental fetch is written into a directory of its own, `delta_{started_at}`, because
+            its pages are numbered from 1 again and would overwrite the pages of the previous runs.
+            A resumed run has the same start time, hence the same directory.
         """
-        regex = re.compile(r'(?P<year>[\d]{4})_(?P<page>[\d]{1,2})_challenge_lst\.json')
-        registrant_params: list[tuple[int, int, str, URL]] = []
+        data_dir = self.output_dir
+        if self.updated_since is not None:
+            data_dir = self.output_dir / f'delta_{self.started_at.strftime("%Y%m%dT%H%M%S")}'
+            data_dir.mkdir(exist_ok=True)
+
+        self.logger.info('Writing the fetched data into %s', data_dir)
+        return self.storage_factory(data_dir)
 
-        for challenge_lst_file in self.output_dir.glob('*_challenge_lst.json'):
-            year, page = map(int, regex.match(challenge_lst_file.name).groups())
-            with open(challenge_lst_file) as f:
-                for challenge in json.load(f):
-                    if challenge['numOfRegistrants'] != 0:
-                        url = RESOURCE_URL.copy()
-                        url.query_param.set('challengeId', challenge['id'])
-                        registrant_params.append((year, page, challenge['id'], url))
+    def request_kwargs(self, phase: str) -> dict:
+        """ Keyword arguments of the requests of a phase: meta, challenge, registrant or member."""
+        return {'timeout': self.timeouts[phase], 'proxy': self.http_config.proxy}
 
-                        self.logger.debug(
-                            'Year %d page %d cha %s | number of registrants: %d',
-                            year, page, challenge['id'], challenge['numOfRegistrants']
-                        )
+    def create_session(self) -> aiohttp.ClientSession:
+        """ Session whose connections are kept alive and shared by all requests of the fetch.
+            Proxies in the `HTTP_PROXY`/`HTTPS_PROXY` environment variables are honored as well.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.http_config.limit_per_host,
+            keepalive_timeout=self.http_config.keepalive_timeout,
+            ttl_dns_cache=self.http_config.dns_ttl,
+        )
+        headers = dict(self.auth_header or {})
+        if not self.http_config.compression:
+            headers['Accept-Encoding'] = 'identity'
+
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers=headers,
+            timeout=self.timeouts['challenge'],
+            raise_for_status=True,
+            trust_env=True,
+        )
+
+    async def get_json(self, session: aiohttp.ClientSession, url: URL, phase: str) -> tuple[typing.Any, int]:
+        """ GET the JSON response, through the response cache if there is one.
+            Return it with the size of its decompressed body, which is 0 when it's not modified since it's cached.
+            A body that is not JSON raises `ValueError`.
+        """
+        with self.metrics.request(phase) as record:
+            if self.response_cache is not None:
+                body = await self.response_cache.get_json(session, url, record, **self.request_kwargs(phase))
+                return body, record.body_bytes
+
+            async with session.get(f'{url}', **self.request_kwargs(phase)) as response:
+                content = await response.read()
+                record.body_bytes = len(content)
+
+            return json.loads(content), record.body_bytes
+
+    def log_metrics(self) -> None:
+        """ Log the request metrics of every endpoint and write them into `metrics_file` if there is one."""
+        summary = self.metrics.summary()
+        for endpoint, endpoint_summary in summary['endpoints'].items():
+            latency = endpoint_summary['latency_seconds']
+            self.logger.info(
+                'Metrics %s | Requests %s | Retries %d | Body bytes %d | Latency avg %.3fs p50 <= %ss p90 <= %ss',
+                endpoint,
+                endpoint_summary['requests'],
+                sum(count for fetch_round, count in endpoint_summary['rounds'].items() if fetch_round > 0),
+                endpoint_summary['body_bytes'],
+                latency['avg'],
+                latency['p50'],
+                latency['p90'],
+            )
+        self.logger.info(
+            'Metrics | Requests in flight max %d avg %.1f', summary['in_flight']['max'], summary['in_flight']['avg'],
+        )
 
-        self.logger.debug('Number of registrant params: %d', len(registrant_params))
+        if self.metrics_file is not None:
+            self.metrics.write(self.metrics_file)
+            self.logger.info('Metrics written to %s', self.metrics_file)
+
+    def construct_registrant_param(
+        self,
+        year: int,
+        page: int,
+        challenge_lst: list[dict],
+    ) -> list[tuple[int, int, str, URL]]:
+        """ Construct the parameters for fetching the challenge registrant from a fetched challenge page."""
+        registrant_params: list[tuple[int, int, str, URL]] = []
+
+        for challenge in challenge_lst:
+            if challenge['numOfRegistrants'] != 0:
+                url = RESOURCE_URL.copy()
+                url.query_param.set('challengeId', challenge['id'])
+                registrant_params.append((year, page, challenge['id'], url))
+
+                self.logger.debug(
+                    'Year %d page %d cha %s | number of registrants: %d',
+                    year, page, challenge['id'], challenge['numOfRegistrants']
+                )
 
         return registrant_params
 
     async def fetch(self) -> None:
         """ Entrance of async fetching."""
+        self.scheduler = RequestScheduler(self.concurrency, self.rate_limit, self.max_backoff, self.logger)
+        run_param = {
+            'status': self.status,
+            'since': self.since.isoformat(),
+            'to': self.to.isoformat(),
+            'incremental': self.incremental,
+        }
 
-        async with aiohttp.ClientSession(headers=self.auth_header, raise_for_status=True) as session:
+        try:
+            async with self.create_session() as session:
+                try:
+                    await self.fetch_all(session, run_param)
+                finally:
+                    await self.cancel_registrant_tasks()
+
+            unfinished = self.journal.count_unfinished()
+            if self.incremental and unfinished > 0:
+                # The changes of a failed window or unit would be skipped for good if the watermark moved past them
+                self.logger.warning(
+                    'Incremental fetch | %d units not fetched, watermark not moved | '
+                    'Run again with --resume to fetch them (failed metadata windows included)',
+                    unfinished,
+                )
+            elif self.incremental:
+                # Challenges updated after the fetch started will be fetched again next time, hence the start time
+                self.journal.set_watermark(self.watermark_keys(self.status), self.started_at)
+                self.logger.info('Incremental fetch | Watermark moved to %s', self.started_at)
+        finally:
+            self.close()
+
+    async def fetch_all(self, session: aiohttp.ClientSession, run_param: dict) -> None:
+        """ Fetch the metadata (unless resuming), the challenges, the registrants and the members."""
+        if self.resume and self.journal.has_unit('challenge'):
+            journal_run_param = self.journal.run_param()
+            started_at = journal_run_param.pop('started_at', None)
+            self.started_at = started_at and datetime.fromisoformat(started_at) or self.started_at
+            if journal_run_param != run_param:
+                self.logger.warning('Resuming journal of a different run: %s', journal_run_param)
+            failed_windows = self.journal.failed_windows()
+            self.logger.info(
+                'Resuming fetch | Failed metadata windows %d | Unfetched challenge pages %d | '
+                'Unfetched registrant lists %d',
+                len(failed_windows),
+                len(self.journal.pending_challenges()),
+                len(self.journal.pending_registrants()),
+            )
+            if failed_windows:
+                await self.fetch_meta(session, failed_windows)
+                self.journal.plan_challenges(self.construct_fetch_challenge_param(self.journal.last_pages()))
+        else:
+            self.journal.reset(**run_param, started_at=self.started_at.isoformat())
             await self.fetch_meta(session)
-            await self.fetch_challenges(session)
-            await self.fetch_registrants(session)
-
-    async def fetch_meta(self, session: aiohttp.ClientSession) -> None:
-        """ Only interpret challenge header to the total and pages."""
+            self.journal.plan_challenges(self.construct_fetch_challenge_param())
+
+        self.storage = self.open_storage()
+        await self.fetch_challenges(session)
+        await self.fetch_registrants(session)
+        if self.stream is not None:
+            await self.stream.drain()
+
+        if self.with_member:
+            await self.fetch_members(session)
+
+    async def cancel_registrant_tasks(self) -> None:
+        """ Cancel the registrant lists still being fetched when the fetch failed, before their session is closed."""
+        for task in self.registrant_tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.registrant_tasks, return_exceptions=True)
+
+    def close(self) -> None:
+        """ Log the metrics and close the journal, the storage and the caches, whether the fetch failed or not."""
+        with contextlib.ExitStack() as stack:  # every callback is run even if one of them raises
+            if self.member_cache is not None:
+                stack.callback(self.member_cache.close)
+            if self.response_cache is not None:
+                stack.callback(self.response_cache.close)  # evicts the least recently used responses
+            if self.storage is not None:
+                stack.callback(self.storage.close)
+            stack.callback(self.journal.close)
+            self.log_metrics()
+
+    async def fetch_meta(
+        self,
+        session: aiohttp.ClientSession,
+        windows: typing.Optional[list[tuple[int, URL]]] = None,
+    ) -> None:
+        """ Only interpret challenge header to the total and pages.
+            A time window with more challenges than the API can paginate through is bisected
+            recursively until every window fits in the pagination limit.
+            The `windows` are the yearly windows of the run, or the failed windows of the journal when resuming.
+        """
         self.logger.info('Fetching Metadata...')
 
-        async def fetch_meta_by_year(session: aiohttp.ClientSession, year: int, url: URL) -> None:
+        async def fetch_meta_by_window(session: aiohttp.ClientSession, year: int, url: URL) -> int:
             """ This function is only used in `fetch_meta` and relatively short. So I write it inside."""
             self.logger.debug('Year %d | %s', year, url)
 
-            try:
-                async with session.head(f'{url}') as response:
-                    self.metadata[year]['total_pages'] = int(response.headers['X-Total-Pages'])
-                    self.metadata[year]['url'] = url
-
-                    self.logger.info(
-                        'Year %d | Total pages %s | Total number of challenges %s',
-                        year,
-                        response.headers['X-Total-Pages'],
-                        response.headers['X-Total']
-                    )
-
-                    return int(response.headers['X-Total'])
-            except aiohttp.ClientResponseError:
-                logging.error('Year %d | Fetching failed', year)
+            request_kwargs = self.request_kwargs('meta')
+            for attempt in range(self.meta_attempts):
+                try:
+                    self.metrics.count_round('meta', attempt, 1)
+                    async with self.scheduler.throttle():
+                        with self.metrics.request('meta'):
+                            async with session.head(f'{url}', **request_kwargs) as response:
+                                total_pages = int(response.headers['X-Total-Pages'])
+                                total = int(response.headers['X-Total'])
+                                self.journal.complete_window(url)
+                                break
+                except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    self.logger.error('Year %d | Fetching failed | Attempt %d', year, attempt)
+            else:
+                self.journal.fail_window(year, url)
+                self.logger.error('Year %d | Window %s dropped after %d attempts', year, url, self.meta_attempts)
                 return 0
 
+            if total > PAGINATION_LIMIT:
+                halves = self.bisect_url(url)
+                if halves is not None:
+                    self.logger.debug('Year %d | Total number of challenges %d | Bisecting %s', year, total, url)
+                    return sum(await asyncio.gather(*[fetch_meta_by_window(session, year, half) for half in halves]))
+
+                total_pages = PAGINATION_LIMIT // int(url.query_param.get('perPage'))
+                self.logger.warning(
+                    'Year %d | Total number of challenges %d can not be split further, truncated to %d pages | %s',
+                    year, total, total_pages, url
+                )
+
+            self.metadata[year].append({'url': url, 'total_pages': total_pages})
+            self.logger.info(
+                'Year %d | Window %s - %s | Total pages %d | Total number of challenges %d',
+                year,
+                url.query_param.get('endDateStart'),
+                url.query_param.get('endDateEnd') or url.query_param.get('startDateEnd'),
+                total_pages,
+                total,
+            )
+
+            return total
+
         coro_queue = [
             asyncio.create_task(
-                fetch_meta_by_year(session, year, url),
+                fetch_meta_by_window(session, year, url),
                 name=f'FetchMeta-Year[{year}]',
-            ) for year, url in self.url_by_year
+            ) for year, url in (self.url_by_year if windows is None else windows)
         ]
         total_cha_by_year = await asyncio.gather(*coro_queue)
+
+        for windows in self.metadata.values():
+            windows.sort(key=lambda window: isoparse(window['url'].query_param.get('endDateStart')))
+
         self.logger.info('Total number of challenges: %d', sum(total_cha_by_year))
 
+    def log_given_up(self, kind: str, num_of_failed: int) -> None:
+        """ The units failing in every round are left failed in the journal, for a later `--resume`."""
+        if num_of_failed > 0:
+            self.logger.error(
+                '%s | %d still failing after %d rounds, given up | Fetch them with --resume',
+                kind, num_of_failed, self.max_rounds,
+            )
+
     async def fetch_challenges(self, session: aiohttp.ClientSession) -> list[tuple[str, int, URL]]:
         """ Call async fetch method to fetch all challenges"""
-        challenge_params, unfetch_challenge_params = [], self.construct_fetch_challenge_param()
+        challenge_params, unfetch_challenge_params = [], self.journal.pending_challenges()
         fetch_rnd = 0
 
-        while len(unfetch_challenge_params) > 0:
+        while len(unfetch_challenge_params) > 0 and fetch_rnd < self.max_rounds:
             self.logger.info('Challenges Fetch round %d | Unfetched %d', fetch_rnd, len(unfetch_challenge_params))
             challenge_params, unfetch_challenge_params = unfetch_challenge_params, []
+            self.metrics.count_round('challenge', fetch_rnd, len(challenge_params))
 
             coro_queue = [
                 asyncio.create_task(
@@ -179,6 +688,8 @@ class Fetcher:
 
             fetch_rnd += 1
 
+        self.log_given_up('Challenges', len(unfetch_challenge_params))
+
     async def fetch_challenge_year_page(
         self,
         session: aiohttp.ClientSession,
@@ -189,32 +700,93 @@ class Fetcher:
     ) -> None:
         """ Fetch a singe page of challengess (100 challenges per page except for the last page)"""
         try:
-            async with session.get(f'{url}') as response:
-                challenge_lst = await response.json()
+            async with self.scheduler.throttle():
+                challenge_lst, num_of_bytes = await self.get_json(session, url, 'challenge')
 
         except aiohttp.ClientResponseError:
             failed_fetch.append((year, url, page))
+            self.journal.fail_challenge(year, page)
             self.logger.error('Year %d page %d | Fetching failed', year, page)
         except asyncio.TimeoutError:
             failed_fetch.append((year, url, page))
+            self.journal.fail_challenge(year, page)
             self.logger.error('Year %d page %d | Fetching timeout', year, page)
+        except aiohttp.ClientConnectionError as err:
+            failed_fetch.append((year, url, page))
+            self.journal.fail_challenge(year, page)
+            self.logger.error('Year %d page %d | Connection error: %s', year, page, err)
+        except ValueError as err:
+            failed_fetch.append((year, url, page))
+            self.journal.fail_challenge(year, page)
+            self.logger.error('Year %d page %d | Invalid JSON: %s', year, page, err)
         else:
             self.logger.info(
                 'Year %d page %d | challenge list length %d | byte size %d',
-                year, page, len(challenge_lst), len(json.dumps(challenge_lst).encode('utf-8'))
+                year, page, len(challenge_lst), num_of_bytes
             )
 
-            with open(self.output_dir / f'{year}_{page}_challenge_lst.json', 'w') as f:
-                json.dump(challenge_lst, f)
+            registrant_params = self.construct_registrant_param(year, page, challenge_lst)
+            self.journal.plan_registrants(registrant_params)
+            self.schedule_registrants(session, registrant_params)
+
+            if self.stream is not None:
+                await self.stream.put_challenge_lst(
+                    year, page, challenge_lst,
+                    on_written=lambda: self.journal.complete_challenge(year, page),
+                )
+                return
+
+            self.storage.write_challenge_lst(year, page, challenge_lst)
+
+            self.journal.complete_challenge(year, page)
+
+    def schedule_registrants(
+        self,
+        session: aiohttp.ClientSession,
+        registrant_params: list[tuple[int, int, str, URL]],
+    ) -> None:
+        """ Start fetching the registrant lists of a challenge page as soon as the page arrives,
+            so that they are fetched while the other pages are still being fetched.
+            A failed one is left in the journal and fetched again by `fetch_registrants`.
+            The lists already done in the journal or being fetched are skipped, a page fetched again (in a later
+            round, or by a resumed run) would fetch and write them twice otherwise.
+        """
+        done = self.journal.done_registrants([challenge_id for _, _, challenge_id, _ in registrant_params])
+        registrant_params = [
+            param for param in registrant_params
+            if param[2] not in done and param[2] not in self.scheduled_registrants
+        ]
+
+        self.metrics.count_round('registrant', 0, len(registrant_params))
+        for year, page, challenge_id, url in registrant_params:
+            task = asyncio.create_task(
+                self.fetch_registrant_year_page(session, year, page, challenge_id, url, []),
+                name=f'FetchRegistrant-year-{year}-page-{page}-cha-{challenge_id}',
+            )
+            self.registrant_tasks.add(task)
+            self.scheduled_registrants.add(challenge_id)
+            task.add_done_callback(self.registrant_tasks.discard)
+            task.add_done_callback(
+                lambda _, challenge_id=challenge_id: self.scheduled_registrants.discard(challenge_id)
+            )
 
     async def fetch_registrants(self, session: aiohttp.ClientSession) -> None:
-        """ Insert regsitrant list into challenge object"""
-        registrant_params, unfetch_registrant_params = [], self.construct_registrant_param()
-        fetch_rnd = 0
+        """ Wait for the registrant lists scheduled along with the challenge pages,
+            then fetch the ones left (failed, or planned by an interrupted run) in rounds.
+        """
+        while self.registrant_tasks:
+            await asyncio.gather(*self.registrant_tasks)
 
-        while len(unfetch_registrant_params) > 0:
+        if self.stream is not None:
+            await self.stream.drain()  # Registrant lists are only done in the journal once written
+
+        registrant_params, unfetch_registrant_params = [], self.journal.pending_registrants()
+        fetch_rnd = 1
+
+        while len(unfetch_registrant_params) > 0 and fetch_rnd < self.max_rounds:
             self.logger.debug('Registrants Fetch round %d | Unfetched %d', fetch_rnd, len(unfetch_registrant_params))
             registrant_params, unfetch_registrant_params = unfetch_registrant_params, []
+            self.metrics.count_round('registrant', fetch_rnd, len(registrant_params))
 
             coro_queue = [
                 asyncio.create_task(
@@ -226,6 +798,8 @@ class Fetcher:
 
             fetch_rnd += 1
 
+        self.log_given_up('Registrants', len(unfetch_registrant_params))
+
     async def fetch_registrant_year_page(
         self,
         session: aiohttp.ClientSession,
@@ -237,8 +811,8 @@ class Fetcher:
     ) -> None:
         """ Fetch single challenge registrant"""
         try:
-            async with session.get(f'{url}') as response:
-                registrant_lst = await response.json()
+            async with self.scheduler.throttle():
+                registrant_lst, _ = await self.get_json(session, url, 'registrant')
 
                 self.logger.info(
                     'Year %d page %d challenge %s | registrant list length %d',
@@ -247,13 +821,130 @@ class Fetcher:
 
         except aiohttp.ClientResponseError:
             failed_fetch.append((year, page, challenge_id, url))
+            self.journal.fail_registrant(challenge_id)
             self.logger.error('Year %d page %d challenge %s | Fetching failed', year, page, challenge_id)
         except asyncio.TimeoutError:
             failed_fetch.append((year, page, challenge_id, url))
+            self.journal.fail_registrant(challenge_id)
             self.logger.error('Year %d page %d challenge %s | Fetching timeout', year, page, challenge_id)
+        except aiohttp.ClientConnectionError as err:
+            failed_fetch.append((year, page, challenge_id, url))
+            self.journal.fail_registrant(challenge_id)
+            self.logger.error('Year %d page %d challenge %s | Connection error: %s', year, page, challenge_id, err)
+        except ValueError as err:
+            failed_fetch.append((year, page, challenge_id, url))
+            self.journal.fail_registrant(challenge_id)
+            self.logger.error('Year %d page %d challenge %s | Invalid JSON: %s', year, page, challenge_id, err)
         else:
-            with open(self.output_dir / f'{year}_{page}_{challenge_id}_registrant_lst.json', 'w') as f:
-                json.dump(registrant_lst, f)
+            if self.with_member:
+                self.journal.plan_members(self.construct_member_param(year, page, registrant_lst))
+
+            if self.stream is not None:
+                await self.stream.put_registrant_lst(
+                    year, page, challenge_id, registrant_lst,
+                    on_written=lambda: self.journal.complete_registrant(challenge_id),
+                )
+                return
+
+            self.storage.write_registrant_lst(year, page, challenge_id, registrant_lst)
+
+            self.journal.complete_registrant(challenge_id)
+
+    def construct_member_param(
+        self,
+        year: int,
+        page: int,
+        registrant_lst: list[dict],
+    ) -> list[tuple[int, int, str, URL]]:
+        """ Construct the parameters for fetching the members of a registrant list, by lower cased handle."""
+        member_params: list[tuple[int, int, str, URL]] = []
+
+        handles_lower = {
+            registrant['memberHandle'].lower() for registrant in registrant_lst if registrant.get('memberHandle')
+        }
+        for handle_lower in sorted(handles_lower):
+            url = MEMBER_URL.copy()
+            url.path += quote(handle_lower)
+            member_params.append((year, page, handle_lower, url))
+
+        return member_params
+
+    async def fetch_members(self, session: aiohttp.ClientSession) -> None:
+        """ Fetch every member registered in the fetched challenges once.
+            Profiles fetched less than `member_ttl` seconds ago, maybe by a previous run, are taken from the cache.
+            The profiles of all members of the run are written to the output once they are all fetched.
+        """
+        member_params, unfetch_member_params = [], self.journal.pending_members()
+        cached = self.member_cache.get_many(
+            [handle_lower for handle_lower, _ in unfetch_member_params],
+            max_age=self.member_ttl,
+        )
+        self.journal.complete_members(list(cached))
+        unfetch_member_params = [
+            (handle_lower, url) for handle_lower, url in unfetch_member_params if handle_lower not in cached
+        ]
+        self.logger.info(
+            'Members | Unique members %d | Cached %d | Unfetched %d',
+            len(self.journal.members()), len(cached), len(unfetch_member_params),
+        )
+        fetch_rnd = 0
+
+        while len(unfetch_member_params) > 0 and fetch_rnd < self.max_rounds:
+            self.logger.debug('Members Fetch round %d | Unfetched %d', fetch_rnd, len(unfetch_member_params))
+            member_params, unfetch_member_params = unfetch_member_params, []
+            self.metrics.count_round('member', fetch_rnd, len(member_params))
 
-    async def fetch_member_by_handle_lower(self, session: aiohttp.ClientSession):
-        """ Fetch user by handleLower."""
+            coro_queue = [
+                asyncio.create_task(
+                    self.fetch_member_by_handle_lower(session, handle_lower, url, unfetch_member_params),
+                    name=f'FetchMember-{handle_lower}-round-{fetch_rnd}'
+                ) for handle_lower, url in member_params
+            ]
+            await asyncio.gather(*coro_queue)
+
+            fetch_rnd += 1
+
+        self.log_given_up('Members', len(unfetch_member_params))
+
+        member_by_handle_lower = self.member_cache.get_many(self.journal.members())
+        self.storage.write_member_lst([member for member in member_by_handle_lower.values() if member is not None])
+
+    async def fetch_member_by_handle_lower(
+        self,
+        session: aiohttp.ClientSession,
+        handle_lower: str,
+        url: URL,
+        failed_fetch: list,
+    ) -> None:
+        """ Fetch a single member profile. A member not found (deleted account) is cached as None."""
+        try:
+            async with self.scheduler.throttle():
+                member, _ = await self.get_json(session, url, 'member')
+
+        except aiohttp.ClientResponseError as err:
+            if err.status != 404:
+                failed_fetch.append((handle_lower, url))
+                self.journal.fail_member(handle_lower)
+                self.logger.error('Member %s | Fetching failed', handle_lower)
+                return
+
+            member = None
+            self.logger.warning('Member %s | Not found', handle_lower)
+        except asyncio.TimeoutError:
+            failed_fetch.append((handle_lower, url))
+            self.journal.fail_member(handle_lower)
+            self.logger.error('Member %s | Fetching timeout', handle_lower)
+            return
+        except aiohttp.ClientConnectionError as err:
+            failed_fetch.append((handle_lower, url))
+            self.journal.fail_member(handle_lower)
+            self.logger.error('Member %s | Connection error: %s', handle_lower, err)
+            return
+        except ValueError as err:
+            failed_fetch.append((handle_lower, url))
+            self.journal.fail_member(handle_lower)
+            self.logger.error('Member %s | Invalid JSON: %s', handle_lower, err)
+            return
+
+        self.member_cache.set_many({handle_lower: member})
+        self.journal.complete_members([handle_lower])
@@ -0,0 +1,288 @@
+""" Request metrics of the fetcher, exported as a Prometheus text file or a JSON summary,
+    and stage timings of the uploader.
+"""
+import os
+import json
+import math
+import time
+import typing
+import asyncio
+import cProfile
+import logging
+import pathlib
+import aiohttp
+import contextlib
+import multiprocessing
+from collections import defaultdict
+
+
+def bound_label(bound: float) -> typing.Union[float, str]:
+    return '+Inf' if math.isinf(bound) else bound
+
+
+class Histogram:
+    """ Cumulative histogram as Prometheus does it, the last bucket is +Inf."""
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+
+    def quantile(self, q: float) -> typing.Union[float, str]:
+        """ Upper bound of the bucket the quantile falls in."""
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= q * self.count:
+                return bound_label(bound)
+
+        return bound_label(math.inf)
+
+
+class RequestRecord:
+    """ Outcome of a single request and the size of its body once decompressed, filled in by the code sending it."""
+    __slots__ = ('outcome', 'body_bytes')
+
+    def __init__(self) -> None:
+        self.outcome = 'ok'
+        self.body_bytes = 0
+
+
+class FetchMetrics:
+    """ Per endpoint (meta, challenge, registrant, member) request counts by outcome, latency histograms
+        and bytes of the decompressed response bodies (not the bytes on the wire, which may be compressed),
+        the number of requests of every fetch round and the requests in flight.
+    """
+    prefix = 'topcoder_fetch'
+
+    def __init__(self) -> None:
+        self.requests: defaultdict[tuple[str, str], int] = defaultdict(int)
+        self.latency: defaultdict[str, Histogram] = defaultdict(Histogram)
+        self.body_bytes: defaultdict[str, int] = defaultdict(int)
+        self.round_requests: defaultdict[tuple[str, int], int] = defaultdict(int)
+
+        self.started_at = time.monotonic()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.in_flight_seconds = 0.0  # Integral of the requests in flight over time, for the average
+        self.last_change = self.started_at
+
+    def count_round(self, endpoint: str, fetch_round: int, num_of_requests: int) -> None:
+        """ Requests of the rounds after the first one are retries."""
+        self.round_requests[(endpoint, fetch_round)] += num_of_requests
+
+    def change_in_flight(self, delta: int) -> None:
+        now = time.monotonic()
+        self.in_flight_seconds += self.in_flight * (now - self.last_change)
+        self.last_change = now
+        self.in_flight += delta
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    @contextlib.contextmanager
+    def request(self, endpoint: str) -> typing.Iterator[RequestRecord]:
+        """ Measure a request from sending it to reading its body, the failure is recorded as its outcome."""
+        record = RequestRecord()
+        self.change_in_flight(1)
+        start = time.monotonic()
+        try:
+            yield record
+        except aiohttp.ClientResponseError as err:
+            record.outcome = str(err.status)
+            raise
+        except asyncio.TimeoutError:
+            record.outcome = 'timeout'
+            raise
+        except aiohttp.ClientConnectionError:
+            record.outcome = 'connection_error'
+            raise
+        except ValueError:  # The body is not JSON, e.g. the HTML error page of a proxy or gateway
+            record.outcome = 'invalid_json'
+            raise
+        finally:
+            self.latency[endpoint].observe(time.monotonic() - start)
+            self.change_in_flight(-1)
+            self.requests[(endpoint, record.outcome)] += 1
+            self.body_bytes[endpoint] += record.body_bytes
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        self.change_in_flight(0)
+        return {
+            'elapsed_seconds': elapsed,
+            'in_flight': {'max': self.max_in_flight, 'avg': self.in_flight_seconds / elapsed if elapsed else 0},
+            'endpoints': {
+                endpoint: {
+                    'requests': {
+                        outcome: count for (req_endpoint, outcome), count in self.requests.items()
+                        if req_endpoint == endpoint
+                    },
+                    'rounds': {
+                        fetch_round: count for (round_endpoint, fetch_round), count in self.round_requests.items()
+                        if round_endpoint == endpoint
+                    },
+                    'body_bytes': self.body_bytes[endpoint],
+                    'latency_seconds': {
+                        'count': histogram.count,
+                        'avg': histogram.sum / histogram.count if histogram.count else 0,
+                        'p50': histogram.quantile(0.5),
+                        'p90': histogram.quantile(0.9),
+                        'p99': histogram.quantile(0.99),
+                        'buckets': {
+                            str(bound_label(bound)): count for bound, count in zip(histogram.buckets, histogram.counts)
+                        },
+                    },
+                } for endpoint, histogram in sorted(self.latency.items())
+            },
+        }
+
+    def prometheus(self) -> str:
+        """ Metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name: str, metric_type: str, help_text: str, samples: list[tuple[str, dict, float]]) -> None:
+            lines.append(f'# HELP {self.prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {self.prefix}_{name} {metric_type}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'{self.prefix}_{name}{suffix}{label_text and "{" + label_text + "}"} {value}')
+
+        metric('requests_total', 'counter', 'Requests sent by the fetcher by outcome.', [
+            ('', {'endpoint': endpoint, 'outcome': outcome}, count)
+            for (endpoint, outcome), count in sorted(self.requests.items())
+        ])
+        metric('request_duration_seconds', 'histogram', 'Time from sending a request to reading its body.', [
+            sample for endpoint, histogram in sorted(self.latency.items()) for sample in [
+                *(
+                    ('_bucket', {'endpoint': endpoint, 'le': bound_label(bound)}, count)
+                    for bound, count in zip(histogram.buckets, histogram.counts)
+                ),
+                ('_sum', {'endpoint': endpoint}, histogram.sum),
+                ('_count', {'endpoint': endpoint}, histogram.count),
+            ]
+        ])
+        metric('response_body_bytes_total', 'counter', 'Bytes of the response bodies once decompressed.', [
+            ('', {'endpoint': endpoint}, count) for endpoint, count in sorted(self.body_bytes.items())
+        ])
+        metric('round_requests_total', 'counter', 'Requests of every fetch round, the rounds after 0 are retries.', [
+            ('', {'endpoint': endpoint, 'round': fetch_round}, count)
+            for (endpoint, fetch_round), count in sorted(self.round_requests.items())
+        ])
+        metric('in_flight_max', 'gauge', 'Maximum number of requests in flight at the same time.', [
+            ('', {}, summary['in_flight']['max']),
+        ])
+        metric('in_flight_avg', 'gauge', 'Average number of requests in flight over the run.', [
+            ('', {}, summary['in_flight']['avg']),
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: pathlib.Path) -> None:
+        """ Write the Prometheus text if the file name ends with `.prom`, the JSON summary otherwise.
+            The file is replaced atomically so that a collector never reads it half-written.
+        """
+        content = self.prometheus() if path.suffix == '.prom' else json.dumps(self.summary(), indent=2)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+
+        os.replace(tmp_path, path)
+
+
+class StageTimer:
+    """ Time spent in the stages of the upload (e.g. `write_challenges`) and in their steps
+        (e.g. `write_challenges.insert`), with the number of times each was run.
+        The steps of a stage run concurrently (pages in flight, worker processes), so their times are summed over
+        all runs and may add up to more than the stage took.
+        With `profile_dir`, every stage is profiled by cProfile into `{profile_dir}/{stage}.prof`.
+    """
+
+    def __init__(self, profile_dir: typing.Optional[pathlib.Path] = None) -> None:
+        self.profile_dir = profile_dir
+        self.seconds: defaultdict[str, float] = defaultdict(float)
+        self.counts: defaultdict[str, int] = defaultdict(int)
+        self.profilers: dict[str, cProfile.Profile] = {}
+
+    @contextlib.contextmanager
+    def step(self, name: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.counts[name] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        """ A step that is also profiled. Stages must not be nested, only one profiler can run at a time."""
+        if self.profile_dir is None:
+            with self.step(name):
+                yield
+            return
+
+        profiler = self.profilers.setdefault(name, cProfile.Profile())
+        with self.step(name):
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+
+    def merge(self, other: 'StageTimer') -> None:
+        """ Add the times of a timer returned by a worker."""
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+            self.counts[name] += other.counts[name]
+
+    def report(self, logger: logging.Logger) -> None:
+        """ Log the times of the stages, each followed by its steps, and dump the profiles."""
+        for name in sorted(self.seconds):
+            logger.info('Timing %-48s | %10.3f seconds | %6d times', name, self.seconds[name], self.counts[name])
+
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(self.profile_dir / f'{name}.prof')
+            logger.info('Profile of %s | %s', name, self.profile_dir / f'{name}.prof')
+
+
+WORKER_PROFILERS: dict[str, cProfile.Profile] = {}  # Profilers of this worker process, by stage
+
+
+@contextlib.contextmanager
+def worker_profile(profile_dir: typing.Optional[pathlib.Path], stage: str) -> typing.Iterator[None]:
+    """ Profile the work of a stage done in a worker process, if `profile_dir` is given. The profile accumulates over
+        the calls in the same process and is dumped after each into `{profile_dir}/{stage}.worker-{pid}.prof`.
+        The work of thread pool workers is not profiled: only one profiler can be enabled at a time in a process
+        since Python 3.12, and the profiler of the stage already is.
+    """
+    if profile_dir is None or multiprocessing.parent_process() is None:
+        yield
+        return
+
+    profiler = WORKER_PROFILERS.setdefault(stage, cProfile.Profile())
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_dir / f'{stage}.worker-{os.getpid()}.prof')
+
+
+def run_timed_step(
+    profile_dir: typing.Optional[pathlib.Path],
+    stage: str,
+    step: str,
+    fn: typing.Callable,
+    *args,
+) -> tuple[typing.Any, StageTimer]:
+    """ Run `fn` in a worker as `{stage}.{step}`. Return its result with the timer to be merged in the parent."""
+    timer = StageTimer()
+    with worker_profile(profile_dir, stage), timer.step(f'{stage}.{step}'):
+        result = fn(*args)
+
+    return result, timer
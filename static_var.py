@@ -12,6 +12,7 @@ MEMBER_URL = URL('{}/v5/members/'.format(os.getenv('API_BASE_URL')))
 CHALLENGE_URL = URL('{}/v5/challenges/?{}'.format(os.getenv('API_BASE_URL'), os.getenv('DEFAULT_CHALLENGE_QUERY')))
 RESOURCE_URL = URL('{}/v5/resources/?perPage=5000'.format(os.getenv('API_BASE_URL')))
 AUTH_TOKEN = os.getenv('JWT') and 'Bearer {}'.format(os.getenv('JWT'))
+PAGINATION_LIMIT = 10000  # perPage * page greater than this returns empty array, see README
 
 MongoConfig = namedtuple('MongoConfig', ['host', 'port', 'username', 'password', 'database'])
 MONGO_CONFIG = MongoConfig(
@@ -22,6 +23,29 @@ MONGO_CONFIG = MongoConfig(
     database=os.getenv("MONGO_DATABASE"),
 )
 
+HttpConfig = namedtuple('HttpConfig', [
+    'limit_per_host',
+    'keepalive_timeout',
+    'dns_ttl',
+    'connect_timeout',
+    'meta_timeout',
+    'read_timeout',
+    'registrant_timeout',
+    'compression',
+    'proxy',
+])
+HTTP_CONFIG = HttpConfig(  # Defaults of the fetcher's command line options
+    limit_per_host=int(os.getenv('HTTP_LIMIT_PER_HOST') or 0),  # 0 means only the overall concurrency applies
+    keepalive_timeout=float(os.getenv('HTTP_KEEPALIVE_TIMEOUT') or 30),
+    dns_ttl=int(os.getenv('HTTP_DNS_TTL') or 300),
+    connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT') or 10),
+    meta_timeout=float(os.getenv('HTTP_META_TIMEOUT') or 15),  # HEAD requests, only the headers are read
+    read_timeout=float(os.getenv('HTTP_READ_TIMEOUT') or 60),
+    registrant_timeout=float(os.getenv('HTTP_REGISTRANT_TIMEOUT') or 180),  # perPage=5000 resource lists
+    compression=os.getenv('HTTP_COMPRESSION', 'true').lower() != 'false',
+    proxy=os.getenv('HTTP_PROXY_URL'),
+)
+
 # Some meta data from topcoder.com, manually written here because it's pretty short
 DETAILED_STATUS = [
     'New',
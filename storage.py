@@ -0,0 +1,258 @@
+""" Storage of the fetched challenge and registrant lists in the output directory."""
+import re
+import gzip
+import json
+import typing
+import pathlib
+import sqlite3
+import zstandard
+
+
+class Codec(typing.NamedTuple):
+    """ Compression of the records of a segment."""
+    suffix: str
+    compress: typing.Callable[[bytes], bytes]
+    decompress: typing.Callable[[bytes], bytes]
+
+
+CODECS = {
+    'gzip': Codec('.jsonl.gz', gzip.compress, gzip.decompress),
+    'zstd': Codec('.jsonl.zst', zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress),
+}
+
+
+class JsonFileStorage:
+    """ One JSON file per page of challenges and per registrant list, i.e.
+        `{year}_{page}_challenge_lst.json` and `{year}_{page}_{challenge_id}_registrant_lst.json`.
+    """
+    regex = re.compile(r'(?P<year>[\d]{4})_(?P<page>[\d]+)_challenge_lst\.json')
+
+    def __init__(self, directory: pathlib.Path) -> None:
+        self.directory = directory
+
+    def close(self) -> None:
+        pass
+
+    def write_challenge_lst(self, year: int, page: int, challenge_lst: list[dict]) -> None:
+        with open(self.directory / f'{year}_{page}_challenge_lst.json', 'w') as f:
+            json.dump(challenge_lst, f)
+
+    def write_registrant_lst(self, year: int, page: int, challenge_id: str, registrant_lst: list[dict]) -> None:
+        with open(self.directory / f'{year}_{page}_{challenge_id}_registrant_lst.json', 'w') as f:
+            json.dump(registrant_lst, f)
+
+    def write_member_lst(self, member_lst: list[dict]) -> None:
+        with open(self.directory / 'member_lst.json', 'w') as f:
+            json.dump(member_lst, f)
+
+    def pages(self) -> list[tuple[int, int]]:
+        """ Sorted year and page of the stored challenge lists."""
+        return sorted(
+            (int(match['year']), int(match['page']))
+            for match in map(self.regex.match, (path.name for path in self.directory.glob('*_challenge_lst.json')))
+            if match is not None
+        )
+
+    def read_challenge_lst(self, year: int, page: int, object_hook=None) -> list[dict]:
+        with open(self.directory / f'{year}_{page}_challenge_lst.json') as f:
+            return json.load(f, object_hook=object_hook)
+
+    def read_registrant_lst(
+        self,
+        year: int,
+        page: int,
+        challenge_id: str,
+        object_hook=None,
+    ) -> typing.Optional[list[dict]]:
+        """ Return None if the registrant list of the challenge is not stored."""
+        try:
+            with open(self.directory / f'{year}_{page}_{challenge_id}_registrant_lst.json') as f:
+                return json.load(f, object_hook=object_hook)
+        except FileNotFoundError:
+            return None
+
+    def read_member_lst(self, object_hook=None) -> typing.Optional[list[dict]]:
+        try:
+            with open(self.directory / 'member_lst.json') as f:
+                return json.load(f, object_hook=object_hook)
+        except FileNotFoundError:
+            return None
+
+
+class SegmentStorage:
+    """ Compressed JSON Lines segments, with the offset of every record indexed in SQLite.
+        A record is the line `{"kind", "year", "page", "challenge_id", "data"}` compressed into a frame of its own,
+        so it can be read from its offset while the segment stays a valid compressed JSON Lines file.
+        Every year has its segments, a new segment is started once the current one is over `segment_size` bytes.
+        Records are only appended, writing a record again points the index to the new copy.
+        The member list is not bound to a year, it's stored as the record of year and page 0.
+        The index is in WAL mode while it's written, which needs memory shared on one host. It's switched back to
+        a rollback journal once closed and opened `read_only` by the readers, which may be on other hosts sharing
+        the directory over a network file system.
+    """
+    index_filename = 'segment_index.sqlite3'
+
+    @classmethod
+    def exists(cls, directory: pathlib.Path) -> bool:
+        return (directory / cls.index_filename).exists()
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        codec: str = 'zstd',
+        segment_size: int = 256 * 2 ** 20,
+        read_only: bool = False,
+    ) -> None:
+        self.directory = directory
+        self.codec = codec
+        self.segment_size = segment_size
+        self.read_only = read_only
+        self.writers: dict[int, tuple[str, typing.BinaryIO]] = {}
+        self.readers: dict[str, typing.BinaryIO] = {}
+
+        if read_only:
+            self.conn = sqlite3.connect(f'{(directory / self.index_filename).resolve().as_uri()}?mode=ro', uri=True)
+            return
+
+        self.conn = sqlite3.connect(directory / self.index_filename)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                """ CREATE TABLE IF NOT EXISTS segment (
+                        name TEXT PRIMARY KEY,
+                        year INTEGER NOT NULL,
+                        codec TEXT NOT NULL
+                    )
+                """
+            )
+            self.conn.execute(
+                """ CREATE TABLE IF NOT EXISTS record (
+                        kind TEXT NOT NULL,
+                        year INTEGER NOT NULL,
+                        page INTEGER NOT NULL,
+                        challenge_id TEXT NOT NULL,
+                        segment TEXT NOT NULL,
+                        offset INTEGER NOT NULL,
+                        length INTEGER NOT NULL,
+                        PRIMARY KEY (kind, year, page, challenge_id)
+                    )
+                """
+            )
+
+    def close(self) -> None:
+        for _, f in self.writers.values():
+            f.close()
+        for f in self.readers.values():
+            f.close()
+        if not self.read_only:
+            self.conn.execute('PRAGMA journal_mode=DELETE')  # Checkpoints and removes the WAL
+        self.conn.close()
+
+    def write_challenge_lst(self, year: int, page: int, challenge_lst: list[dict]) -> None:
+        self.append('challenge', year, page, '', challenge_lst)
+
+    def write_registrant_lst(self, year: int, page: int, challenge_id: str, registrant_lst: list[dict]) -> None:
+        self.append('registrant', year, page, challenge_id, registrant_lst)
+
+    def write_member_lst(self, member_lst: list[dict]) -> None:
+        self.append('member', 0, 0, '', member_lst)
+
+    def append(self, kind: str, year: int, page: int, challenge_id: str, data: list[dict]) -> None:
+        record = {'kind': kind, 'year': year, 'page': page, 'challenge_id': challenge_id or None, 'data': data}
+        frame = CODECS[self.codec].compress(json.dumps(record).encode('utf-8') + b'\n')
+
+        segment, f = self.segment_writer(year)
+        offset = f.tell()
+        f.write(frame)
+        f.flush()
+
+        with self.conn:
+            self.conn.execute(
+                """ INSERT OR REPLACE INTO record (kind, year, page, challenge_id, segment, offset, length)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (kind, year, page, challenge_id, segment, offset, len(frame)),
+            )
+
+    def segment_writer(self, year: int) -> tuple[str, typing.BinaryIO]:
+        """ The segment of the year being appended to, start a new one if it's full."""
+        if year in self.writers and self.writers[year][1].tell() < self.segment_size:
+            return self.writers[year]
+
+        if year in self.writers:
+            self.writers.pop(year)[1].close()
+
+        names = [
+            name for name, in self.conn.execute(
+                'SELECT name FROM segment WHERE year = ? AND codec = ? ORDER BY name', (year, self.codec)
+            )
+        ]
+        if names and (self.directory / names[-1]).stat().st_size < self.segment_size:
+            name = names[-1]
+        else:
+            num_of_segments, = self.conn.execute('SELECT COUNT(*) FROM segment WHERE year = ?', (year,)).fetchone()
+            name = f'{year}_{num_of_segments:04d}{CODECS[self.codec].suffix}'
+            with self.conn:
+                self.conn.execute('INSERT INTO segment (name, year, codec) VALUES (?, ?, ?)', (name, year, self.codec))
+
+        f = open(self.directory / name, 'ab')
+        f.seek(0, 2)  # The position of a file opened for appending is only at its end after the first write
+        self.writers[year] = (name, f)
+        return self.writers[year]
+
+    def pages(self) -> list[tuple[int, int]]:
+        """ Sorted year and page of the stored challenge lists."""
+        return self.conn.execute(
+            "SELECT year, page FROM record WHERE kind = 'challenge' ORDER BY year, page"
+        ).fetchall()
+
+    def read_challenge_lst(self, year: int, page: int, object_hook=None) -> list[dict]:
+        data = self.read('challenge', year, page, '', object_hook)
+        if data is None:
+            raise FileNotFoundError(f'Year {year} page {page} challenge list is not in {self.directory}')
+
+        return data
+
+    def read_registrant_lst(
+        self,
+        year: int,
+        page: int,
+        challenge_id: str,
+        object_hook=None,
+    ) -> typing.Optional[list[dict]]:
+        """ Return None if the registrant list of the challenge is not stored."""
+        return self.read('registrant', year, page, challenge_id, object_hook)
+
+    def read_member_lst(self, object_hook=None) -> typing.Optional[list[dict]]:
+        return self.read('member', 0, 0, '', object_hook)
+
+    def read(self, kind: str, year: int, page: int, challenge_id: str, object_hook=None) -> typing.Optional[list]:
+        row = self.conn.execute(
+            """ SELECT record.segment, segment.codec, record.offset, record.length
+                FROM record JOIN segment ON record.segment = segment.name
+                WHERE kind = ? AND record.year = ? AND page = ? AND challenge_id = ?
+            """,
+            (kind, year, page, challenge_id),
+        ).fetchone()
+        if row is None:
+            return None
+
+        segment, codec, offset, length = row
+        if segment not in self.readers:
+            self.readers[segment] = open(self.directory / segment, 'rb')
+
+        f = self.readers[segment]
+        f.seek(offset)
+        return json.loads(CODECS[codec].decompress(f.read(length)), object_hook=object_hook)['data']
+
+
+Storage = typing.Union[JsonFileStorage, SegmentStorage]
+
+
+def open_storage(directory: pathlib.Path) -> Storage:
+    """ Open the fetched data in the directory for reading, whichever format it's stored in."""
+    if SegmentStorage.exists(directory):
+        return SegmentStorage(directory, read_only=True)
+
+    return JsonFileStorage(directory)
@@ -1,13 +1,40 @@
 """ Command line interface of Topcoder data collector."""
 import os
+import typing
+import functools
 import asyncio
+import logging
 import argparse
 from pathlib import Path
 from fetcher import Fetcher
-from static_var import Status
+from storage import JsonFileStorage, SegmentStorage
+from static_var import HTTP_CONFIG, HttpConfig, Status
 from datetime import datetime, timezone, timedelta
 from util import replace_datetime_tail, init_logger
 
+if typing.TYPE_CHECKING:
+    from topcoder_mongo import ChallengeStreamWriter
+
+
+async def fetch_into_mongo(
+    fetcher: Fetcher,
+    stream: 'ChallengeStreamWriter',
+    output_dir: Path,
+    logger: logging.Logger,
+) -> None:
+    """ Stream the fetched challenges into MongoDB and rebuild the projects from them."""
+    from topcoder_mongo import TopcoderMongo
+
+    mongo = TopcoderMongo(logger, output_dir)
+    await mongo.create_indexes('challenge')  # the stream upserts by challenge id
+
+    async with stream:
+        await fetcher.fetch()
+
+    await mongo.write_projects()
+    await mongo.create_indexes('project')
+    await mongo.write_project_section_sim()
+
 
 def init():
     """ Entrance of CLI"""
@@ -19,6 +46,20 @@ def init():
         default=False,  # Temporary setting
         help='Whether fetch registrant details or not.'
     )
+    parser.add_argument(
+        '--with-member',
+        action='store_true',
+        dest='with_member',
+        default=False,
+        help='Whether fetch the profile of every registrant, once per member.'
+    )
+    parser.add_argument(
+        '--member-ttl',
+        dest='member_ttl',
+        default=30,
+        type=float,
+        help='Days before a cached member profile is fetched again.'
+    )
     parser.add_argument(
         '--status',
         dest='status',
@@ -54,6 +95,151 @@ def init():
         type=Path,
         help='Directory for stroage of logs. Create one if not exist',
     )
+    parser.add_argument(
+        '--concurrency',
+        dest='concurrency',
+        default=50,
+        type=int,
+        help='Maximum number of requests in flight at the same time.',
+    )
+    parser.add_argument(
+        '--rate-limit',
+        dest='rate_limit',
+        default=20,
+        type=float,
+        help='Maximum number of requests sent per second. Set to 0 to disable rate limiting.',
+    )
+    parser.add_argument(
+        '--max-backoff',
+        dest='max_backoff',
+        default=60,
+        type=float,
+        help='Maximum seconds to pause the requests when the API responds 429/5xx.',
+    )
+    parser.add_argument(
+        '--max-rounds',
+        dest='max_rounds',
+        default=10,
+        type=int,
+        help='Rounds of retries of the failed pages, registrant lists and members before giving up on them.',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Resume the interrupted fetch from the journal in the output directory.'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Only fetch the challenges updated since the last incremental fetch, into a `delta_*` subdirectory.'
+    )
+    parser.add_argument(
+        '--stream-to-mongo',
+        action='store_true',
+        dest='stream_to_mongo',
+        default=False,
+        help='Write the fetched data straight into MongoDB instead of JSON files, then rebuild the projects.'
+    )
+    parser.add_argument(
+        '--stream-workers',
+        dest='stream_workers',
+        default=None,
+        type=int,
+        help='Number of processes processing the streamed pages with --stream-to-mongo. Default to the number of CPUs.'
+    )
+    parser.add_argument(
+        '--limit-per-host',
+        dest='limit_per_host',
+        default=HTTP_CONFIG.limit_per_host,
+        type=int,
+        help='Maximum number of connections to the API host, 0 for no limit other than the concurrency.',
+    )
+    parser.add_argument(
+        '--keepalive-timeout',
+        dest='keepalive_timeout',
+        default=HTTP_CONFIG.keepalive_timeout,
+        type=float,
+        help='Seconds an idle connection is kept open for reuse.',
+    )
+    parser.add_argument(
+        '--dns-ttl',
+        dest='dns_ttl',
+        default=HTTP_CONFIG.dns_ttl,
+        type=int,
+        help='Seconds the resolved address of a host is cached.',
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        dest='connect_timeout',
+        default=HTTP_CONFIG.connect_timeout,
+        type=float,
+        help='Seconds to wait for a new connection to be established.',
+    )
+    parser.add_argument(
+        '--meta-timeout',
+        dest='meta_timeout',
+        default=HTTP_CONFIG.meta_timeout,
+        type=float,
+        help='Seconds to wait for the response of a metadata (HEAD) request.',
+    )
+    parser.add_argument(
+        '--read-timeout',
+        dest='read_timeout',
+        default=HTTP_CONFIG.read_timeout,
+        type=float,
+        help='Seconds to wait between two reads of a challenge page or member response.',
+    )
+    parser.add_argument(
+        '--registrant-timeout',
+        dest='registrant_timeout',
+        default=HTTP_CONFIG.registrant_timeout,
+        type=float,
+        help='Seconds to wait between two reads of a registrant list response.',
+    )
+    parser.add_argument(
+        '--no-compression',
+        action='store_false',
+        dest='compression',
+        default=HTTP_CONFIG.compression,
+        help='Ask the API for uncompressed responses.',
+    )
+    parser.add_argument(
+        '--proxy',
+        dest='proxy',
+        default=HTTP_CONFIG.proxy,
+        type=lambda proxy: f'http://127.0.0.1:{proxy}' if proxy.isdigit() else proxy,
+        help='Proxy URL of the requests, or the port of a local HTTP proxy.',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        dest='metrics_file',
+        default=None,
+        type=Path,
+        help='Write the request metrics at the end of the fetch, in Prometheus text format if it ends with .prom.',
+    )
+    parser.add_argument(
+        '--http-cache-size',
+        dest='http_cache_size',
+        default=512,
+        type=int,
+        help='Size limit in MB of the HTTP response cache in the output directory, 0 to disable the cache.'
+    )
+    parser.add_argument(
+        '--storage',
+        dest='storage',
+        default='json',
+        choices=['json', 'zstd', 'gzip'],
+        help='Write a JSON file per page and registrant list, or append them to compressed JSON Lines segments.'
+    )
+    parser.add_argument(
+        '--segment-size',
+        dest='segment_size',
+        default=256,
+        type=int,
+        help='Size in MB after which a new segment is started, with compressed storage.'
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -67,6 +253,19 @@ def init():
         print('since value should not be greatter than to value.')
         exit(1)
 
+    if args.concurrency < 1:
+        print('concurrency value should be a positive integer.')
+        exit(1)
+
+    if args.storage == 'json':
+        holds_other_format = SegmentStorage.exists(args.output_dir)
+    else:
+        holds_other_format = len(JsonFileStorage(args.output_dir).pages()) > 0
+
+    if holds_other_format:
+        print(f'{args.output_dir} already holds data in another storage format than {args.storage}.')
+        exit(1)
+
     if not args.output_dir.is_dir():
         os.mkdir(args.output_dir)
 
@@ -75,7 +274,44 @@ def init():
 
     logger = init_logger(args.log_dir, 'fetch', args.debug)
 
-    asyncio.run(Fetcher(args.status, args.since, args.to, args.with_registrant, args.output_dir, logger).fetch())
+    if args.storage == 'json':
+        storage_factory = JsonFileStorage
+    else:
+        storage_factory = functools.partial(
+            SegmentStorage, codec=args.storage, segment_size=args.segment_size * 2 ** 20,
+        )
+
+    stream = None
+    if args.stream_to_mongo:
+        from topcoder_mongo import ChallengeStreamWriter  # Only import (and connect to) MongoDB when asked to
+        stream = ChallengeStreamWriter(logger, workers=args.stream_workers)
+
+    fetcher = Fetcher(
+        args.status,
+        args.since,
+        args.to,
+        args.with_registrant,
+        args.output_dir,
+        logger,
+        concurrency=args.concurrency,
+        rate_limit=args.rate_limit,
+        max_backoff=args.max_backoff,
+        max_rounds=args.max_rounds,
+        resume=args.resume,
+        incremental=args.incremental,
+        stream=stream,
+        storage_factory=storage_factory,
+        with_member=args.with_member,
+        member_ttl=args.member_ttl * 24 * 3600,
+        http_cache_size=args.http_cache_size * 2 ** 20,
+        metrics_file=args.metrics_file,
+        http_config=HttpConfig(**{field: getattr(args, field) for field in HttpConfig._fields}),
+    )
+
+    if stream is None:
+        asyncio.run(fetcher.fetch())
+    else:
+        asyncio.run(fetch_into_mongo(fetcher, stream, args.output_dir, logger))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+""" Command line interface of Topcoder data exporter."""
+import os
+import asyncio
+import argparse
+from pathlib import Path
+from topcoder_parquet import ParquetExporter, export_from_files, export_from_mongo
+from util import init_logger
+
+
+def init():
+    """ Entrance of CLI"""
+    parser = argparse.ArgumentParser(description='Topcoder Data Exporter command line tool, into Parquet files.')
+    parser.add_argument(
+        '--source',
+        dest='source',
+        default='files',
+        choices=['files', 'mongo'],
+        help='Export the fetched files in the input directory or the challenge collection in MongoDB.'
+    )
+    parser.add_argument(
+        '--input-dir',
+        dest='input_dir',
+        default=Path(os.path.join(os.curdir, 'data')),
+        type=Path,
+        help='Directory for storoage of the fetched data.',
+    )
+    parser.add_argument(
+        '--output-dir',
+        dest='output_dir',
+        default=Path(os.path.join(os.curdir, 'parquet')),
+        type=Path,
+        help='Directory for the exported datasets. The previous export in it is replaced.',
+    )
+    parser.add_argument(
+        '--log-dir',
+        dest='log_dir',
+        default=Path(os.path.join(os.curdir, 'logs')),
+        type=Path,
+        help='Directory for stroage of logs. Create one if not exist',
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        default=False,
+        help='Whether to log debug level message.'
+    )
+    parser.add_argument(
+        '--compression',
+        dest='compression',
+        default='zstd',
+        choices=['zstd', 'snappy', 'gzip', 'none'],
+        help='Compression codec of the Parquet files.'
+    )
+    parser.add_argument(
+        '--row-group-size',
+        dest='row_group_size',
+        default=10000,
+        type=int,
+        help='Number of rows per row group of the Parquet files.'
+    )
+
+    args = parser.parse_args()
+
+    if args.source == 'files' and not args.input_dir.is_dir():
+        print(f'{args.input_dir} is not a directory.')
+        exit(1)
+
+    if not args.log_dir.is_dir():
+        os.mkdir(args.log_dir)
+
+    logger = init_logger(args.log_dir, 'parquet_export', args.debug)
+
+    exporter = ParquetExporter(logger, args.output_dir, args.compression, args.row_group_size)
+    if args.source == 'files':
+        export_from_files(exporter, args.input_dir)
+    else:
+        asyncio.get_event_loop().run_until_complete(export_from_mongo(exporter))
+
+
+if __name__ == '__main__':
+    init()
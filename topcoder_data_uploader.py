@@ -1,8 +1,10 @@
 """ Command line interface of Topcoder data uploader."""
 import os
+import socket
 import asyncio
 import argparse
 from pathlib import Path
+from datetime import datetime
 from topcoder_mongo import TopcoderMongo
 from util import init_logger
 
@@ -30,6 +32,129 @@ def init():
         default=False,
         help='Whether to log debug level message.'
     )
+    parser.add_argument(
+        '--sim-executor',
+        dest='sim_executor',
+        default='process',
+        choices=['process', 'thread'],
+        help='Run the section similarity computation in a process pool or a thread pool.'
+    )
+    parser.add_argument(
+        '--sim-workers',
+        dest='sim_workers',
+        default=None,
+        type=int,
+        help='Number of workers computing section similarity. Default to the number of CPUs.'
+    )
+    parser.add_argument(
+        '--sim-batch-size',
+        dest='sim_batch_size',
+        default=32,
+        type=int,
+        help='Number of project sections sent to a worker at once.'
+    )
+    parser.add_argument(
+        '--global-idf',
+        action='store_true',
+        dest='global_idf',
+        default=False,
+        help='Fit one tfidf model on all section texts instead of one per project section.'
+    )
+    parser.add_argument(
+        '--sim-write-batch-size',
+        dest='sim_write_batch_size',
+        default=1000,
+        type=int,
+        help='Number of project section similarity updates sent to MongoDB in one bulk write.'
+    )
+    parser.add_argument(
+        '--project-write-batch-size',
+        dest='project_write_batch_size',
+        default=1000,
+        type=int,
+        help='Number of projects written in one bulk write, if they can not be written on the server side.'
+    )
+    parser.add_argument(
+        '--preprocess-workers',
+        dest='preprocess_workers',
+        default=None,
+        type=int,
+        help='Number of processes pre-processing the challenge files. Default to the number of CPUs.'
+    )
+    parser.add_argument(
+        '--preprocess-in-flight',
+        dest='preprocess_in_flight',
+        default=None,
+        type=int,
+        help='Maximum number of challenge files being pre-processed or inserted at once. Default to twice the workers.'
+    )
+    parser.add_argument(
+        '--description-cache-size',
+        dest='description_cache_size',
+        default=256,
+        type=int,
+        help='Size limit in MB of the description cache, 0 to disable it (and with --run-id without --cache-dir).'
+    )
+    parser.add_argument(
+        '--token-cache-size',
+        dest='token_cache_size',
+        default=256,
+        type=int,
+        help='Size limit in MB of the section token cache, 0 to disable it (and with --run-id without --cache-dir).'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        dest='cache_dir',
+        default=None,
+        type=Path,
+        help='Directory of the description and token caches. Default to the input directory, or to its parent '
+             'for the `delta_*` directory of an incremental fetch. Use a local directory with --run-id.'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Upsert the challenges and only recompute their projects instead of rebuilding the database.'
+    )
+    parser.add_argument(
+        '--index-background',
+        action='store_true',
+        dest='index_background',
+        default=False,
+        help='Build the indexes in the background so that the collections stay available meanwhile.'
+    )
+    parser.add_argument(
+        '--run-id',
+        dest='run_id',
+        default=None,
+        help='Upload as one of the workers sharing this run id, each worker upserts the challenge files it claims.'
+    )
+    parser.add_argument(
+        '--worker-id',
+        dest='worker_id',
+        default=f'{socket.gethostname()}-{os.getpid()}',
+        help='Identity of the worker in a sharded upload. Default to the host name and the process id.'
+    )
+    parser.add_argument(
+        '--lease-seconds',
+        dest='lease_seconds',
+        default=300,
+        type=int,
+        help='Seconds before the challenge file claimed by a worker of a sharded upload can be claimed again.'
+    )
+    parser.add_argument(
+        '--shard-attempts',
+        dest='shard_attempts',
+        default=3,
+        type=int,
+        help='Times a challenge file of a sharded upload is claimed before it is given up, if it fails every time.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help='Profile every stage of the upload with cProfile, into a `profile_*` directory in the log directory.'
+    )
     parser.add_argument(
         '--db',
         default='mongo',
@@ -47,8 +172,50 @@ def init():
 
     logger = init_logger(args.log_dir, f'{args.db}_upload', args.debug)
 
+    profile_dir = None
+    if args.profile:
+        profile_dir = args.log_dir / f'profile_{datetime.now().timestamp()}'
+        os.mkdir(profile_dir)
+
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        # The delta of an incremental fetch is in a new directory every time, the caches stay in the output directory
+        cache_dir = args.input_dir.parent if args.input_dir.name.startswith('delta_') else args.input_dir
+    if not cache_dir.is_dir():
+        os.makedirs(cache_dir)
+
+    description_cache_size = args.description_cache_size * 2 ** 20
+    token_cache_size = args.token_cache_size * 2 ** 20
+    if args.run_id is not None and args.cache_dir is None and (description_cache_size or token_cache_size):
+        # The workers of a sharded upload share the input directory, likely over a network file system
+        # where SQLite can't lock the caches safely
+        logger.info('Sharded upload | the description and token caches are disabled unless --cache-dir is given')
+        description_cache_size = token_cache_size = 0
+
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(TopcoderMongo(logger, args.input_dir).initiate_database())
+    mongo = TopcoderMongo(
+        logger,
+        args.input_dir,
+        sim_executor=args.sim_executor,
+        sim_workers=args.sim_workers,
+        sim_batch_size=args.sim_batch_size,
+        global_idf=args.global_idf,
+        sim_write_batch_size=args.sim_write_batch_size,
+        project_write_batch_size=args.project_write_batch_size,
+        preprocess_workers=args.preprocess_workers,
+        preprocess_in_flight=args.preprocess_in_flight,
+        description_cache_size=description_cache_size,
+        token_cache_size=token_cache_size,
+        index_background=args.index_background,
+        profile_dir=profile_dir,
+        cache_dir=cache_dir,
+    )
+    if args.run_id is not None:
+        loop.run_until_complete(
+            mongo.upload_shards(args.run_id, args.worker_id, args.lease_seconds, args.shard_attempts)
+        )
+    else:
+        loop.run_until_complete(mongo.update_database() if args.incremental else mongo.initiate_database())
 
 
 if __name__ == '__main__':
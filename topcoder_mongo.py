@@ -1,23 +1,49 @@
 """ Methods for MongoDB operation including writing fetched data and query data."""
-import re
-import json
+import os
 import typing
+import hashlib
 import asyncio
+import contextlib
 import logging
 import pathlib
 import markdown
+import multiprocessing.util
 import motor.motor_asyncio
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+from pymongo import ASCENDING, IndexModel, InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import OperationFailure
 from asyncio import AbstractEventLoop
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
 from url import URL
+from storage import open_storage
+from metrics import StageTimer, run_timed_step, worker_profile
 from static_var import MONGO_CONFIG, TRACK
-from util import snake_case_json_key, convert_datetime_json_value, html_to_sectioned_text
-from topcoder_nlp import compute_section_text_similarity
+from util import (
+    KeyValueCache,
+    html_to_sectioned_text,
+    markdown_to_sectioned_text,
+    normalize_json,
+    normalize_json_object,
+)
+from topcoder_nlp import (
+    compute_tokenized_section_similarity_batch,
+    fit_tfidf,
+    init_shared_tfidf,
+    token_cache_key,
+    tokenize_batch,
+)
 
 MONGO_CLIENT: typing.Any = None
 
+# Version of the sectioning, bump it when it changes to invalidate cached results. The Markdown descriptions are
+# rendered by Python-Markdown first, so its version is part of it too.
+DESCRIPTION_CACHE_VERSION = f'sectioned_text-v2-markdown-{markdown.__version__}'
+
+# Cache of the processed descriptions, opened in each pre-processing worker by `init_description_cache`
+DESCRIPTION_CACHE: typing.Optional[KeyValueCache] = None
+
 
 def construct_mongo_url():
     """ Construct URL for connecting to MongoDB."""
@@ -49,6 +75,110 @@ def get_collection(collection_name: str) -> motor.motor_asyncio.AsyncIOMotorColl
     return db.get_collection(collection_name)
 
 
+def process_challenge_lst(challenge_lst: list[dict]) -> list[dict]:
+    """ Snake case the keys, convert the datetime values and sectionize the description of fetched challenges."""
+    return sectionize_description(normalize_json(challenge_lst))
+
+
+def process_registrant_lst(registrant_lst: list[dict]) -> list[dict]:
+    """ Snake case the keys and convert the datetime values of fetched registrants."""
+    return normalize_json(registrant_lst)
+
+
+def init_description_cache(path: typing.Optional[pathlib.Path], max_bytes: typing.Optional[int] = None) -> None:
+    """ Initializer of the pre-processing workers, every worker has its own connection."""
+    global DESCRIPTION_CACHE
+    DESCRIPTION_CACHE = KeyValueCache(path, max_bytes) if path else None
+    if DESCRIPTION_CACHE is not None:  # closed when the worker exits, to write the hits not flushed yet
+        multiprocessing.util.Finalize(DESCRIPTION_CACHE, DESCRIPTION_CACHE.close, exitpriority=0)
+
+
+def description_cache_key(description: str, description_format: str) -> str:
+    """ Key of the processed description in the description cache."""
+    key = f'{DESCRIPTION_CACHE_VERSION}\0{description_format}\0{description}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def process_description(description: str, description_format: str) -> list[dict]:
+    """ Sectionize a HTML or Markdown description."""
+    return (
+        html_to_sectioned_text(description)
+        if description_format == 'HTML' else
+        markdown_to_sectioned_text(description)
+    )
+
+
+def sectionize_description(challenge_lst: list[dict]) -> list[dict]:
+    """ Sectionize the description of challenges already normalized by `normalize_json`.
+        The processed descriptions are read from and saved to `DESCRIPTION_CACHE` if there is one.
+    """
+    described = [
+        challenge for challenge in challenge_lst
+        if 'description' in challenge and 'description_format' in challenge
+    ]
+    if DESCRIPTION_CACHE is None:
+        for challenge in described:
+            challenge['processed_description'] = process_description(
+                challenge['description'],
+                challenge['description_format'],
+            )
+
+        return challenge_lst
+
+    keys = [
+        description_cache_key(challenge['description'], challenge['description_format']) for challenge in described
+    ]
+    processed = DESCRIPTION_CACHE.get_many(keys, touch=True)
+    missing = {}
+    for key, challenge in zip(keys, described):
+        if key not in processed:
+            processed[key] = missing[key] = process_description(
+                challenge['description'],
+                challenge['description_format'],
+            )
+
+        challenge['processed_description'] = processed[key]
+
+    if missing:
+        DESCRIPTION_CACHE.set_many(missing)
+
+    return challenge_lst
+
+
+def load_challenge_year_page(
+    input_dir: pathlib.Path,
+    year: int,
+    page: int,
+    profile_dir: typing.Optional[pathlib.Path] = None,
+) -> tuple[list[dict], StageTimer]:
+    """ Read and pre-process a page of fetched challenges together with their registrant lists.
+        It's run in the worker processes of the uploader, the timer of its steps is returned with the challenges.
+        The keys and the datetime values are normalized as the JSON is decoded, so they are timed as one step.
+    """
+    timer = StageTimer()
+    storage = open_storage(input_dir)
+    try:
+        with worker_profile(profile_dir, 'write_challenges'):
+            with timer.step('write_challenges.decode_normalize_challenges'):
+                challenge_lst = storage.read_challenge_lst(year, page, normalize_json_object)
+
+            with timer.step('write_challenges.sectionize'):
+                sectionize_description(challenge_lst)
+
+            with timer.step('write_challenges.decode_normalize_registrants'):
+                for challenge in challenge_lst:
+                    if challenge['num_of_registrants'] > 0:
+                        registrant_lst = storage.read_registrant_lst(
+                            year, page, challenge['id'], normalize_json_object,
+                        )
+                        if registrant_lst is not None:
+                            challenge['registrant_lst'] = registrant_lst
+    finally:
+        storage.close()
+
+    return challenge_lst, timer
+
+
 class ProjectSection(typing.TypedDict):
     """ Type def of project in section text similarity computation."""
     project_id: int
@@ -57,22 +187,99 @@ class ProjectSection(typing.TypedDict):
     section_freq: int
 
 
+class IndexSpec(typing.NamedTuple):
+    """ Declaration of an index and the queries it serves."""
+    keys: list[tuple[str, int]]
+    serves: str
+    unique: bool = False
+
+
 class TopcoderMongo:
     """ MongoDB database operation using Motor"""
     challenge = get_collection('challenge')
     project = get_collection('project')
-    regex = re.compile(r'(?P<year>[\d]{4})_(?P<page>[\d]{1,2})_challenge_lst\.json')
+    lease = get_collection('upload_lease')
+    lease_poll_interval = 5
+    token_cache_filename = 'token_cache.sqlite3'
+    description_cache_filename = 'description_cache.sqlite3'
+    indexes = {
+        'challenge': [
+            IndexSpec(
+                [('id', ASCENDING)],
+                'upsert of challenges by id (incremental, sharded upload, streaming fetch), unique so that concurrent '
+                'upserts of a challenge can\'t insert it twice',
+                unique=True,
+            ),
+            IndexSpec([('project_id', ASCENDING)], '$match on project_id of write_projects/write_project_section_sim'),
+            IndexSpec([('track', ASCENDING), ('status', ASCENDING)], 'challenges filtered by track and status'),
+            IndexSpec([('start_date', ASCENDING)], 'challenges filtered or sorted by start date'),
+            IndexSpec([('end_date', ASCENDING)], 'challenges filtered or sorted by end date'),
+        ],
+        'project': [
+            IndexSpec(
+                [('id', ASCENDING)],
+                '$merge of aggregated projects, section similarity updates and deletion of projects by id',
+                unique=True,
+            ),
+        ],
+        'lease': [
+            IndexSpec([('run_id', ASCENDING), ('kind', ASCENDING), ('state', ASCENDING)], 'claims of sharded uploads'),
+        ],
+    }
+    index_conflict_codes = {85, 86}  # IndexOptionsConflict, IndexKeySpecsConflict
+    duplicate_key_code = 11000
+    tokenize_batch_size = 256
 
-    def __init__(self, logger: logging.Logger, input_dir: pathlib.Path) -> None:
+    def __init__(
+        self,
+        logger: logging.Logger,
+        input_dir: pathlib.Path,
+        sim_executor: str = 'process',
+        sim_workers: typing.Optional[int] = None,
+        sim_batch_size: int = 32,
+        global_idf: bool = False,
+        sim_write_batch_size: int = 1000,
+        project_write_batch_size: int = 1000,
+        preprocess_workers: typing.Optional[int] = None,
+        preprocess_in_flight: typing.Optional[int] = None,
+        description_cache_size: int = 256 * 2 ** 20,
+        token_cache_size: int = 256 * 2 ** 20,
+        index_background: bool = False,
+        profile_dir: typing.Optional[pathlib.Path] = None,
+        cache_dir: typing.Optional[pathlib.Path] = None,
+    ) -> None:
         self.logger = logger
         self.input_dir = input_dir
+        self.cache_dir = cache_dir or input_dir  # The token and description caches, kept across runs
+
+        self.preprocess_workers = preprocess_workers or os.cpu_count()
+        self.preprocess_in_flight = preprocess_in_flight or 2 * self.preprocess_workers
+        self.description_cache_size = description_cache_size
+        self.token_cache_size = token_cache_size
+
+        self.sim_executor = sim_executor
+        self.sim_workers = sim_workers or os.cpu_count()
+        self.sim_batch_size = sim_batch_size
+        self.global_idf = global_idf
+        self.sim_write_batch_size = sim_write_batch_size
+        self.project_write_batch_size = project_write_batch_size
+
+        self.index_background = index_background
+        self.timer = StageTimer(profile_dir)
+        self.inserted_ids: set[str] = set()  # The challenge id index is unique, a page may repeat a challenge
+
+    @property
+    def sim_executor_cls(self) -> typing.Type[Executor]:
+        return ProcessPoolExecutor if self.sim_executor == 'process' else ThreadPoolExecutor
 
     async def initiate_database(self) -> None:
         start_initiation = datetime.now()
         await self.challenge.drop()
         await self.project.drop()
         await self.write_challenges()
+        await self.create_indexes('challenge')  # after the bulk load, it's cheaper than maintaining them
         await self.write_projects()
+        await self.create_indexes('project')
         await self.write_project_section_sim()
         end_initiation = datetime.now()
         self.logger.info(
@@ -84,9 +291,101 @@ class TopcoderMongo:
             'Initiation finished, total time used: %d seconds',
             (end_initiation - start_initiation).total_seconds()
         )
+        self.timer.report(self.logger)
+
+    async def update_database(self) -> None:
+        """ Upsert the fetched challenges instead of rebuilding the database.
+            Only the projects the challenges belong to, before or after the update, are recomputed.
+        """
+        start_update = datetime.now()
+        await self.create_indexes('challenge')
+        await self.create_indexes('project')
+
+        project_ids = await self.write_challenges(upsert=True)
+        self.logger.info('Updating %d projects of the upserted challenges', len(project_ids))
+        if project_ids:
+            await self.write_projects(project_ids)
+            await self.write_project_section_sim(project_ids)
+
+        end_update = datetime.now()
+        self.logger.info(
+            'Update finished, total time used: %d seconds',
+            (end_update - start_update).total_seconds()
+        )
+        self.timer.report(self.logger)
+
+    async def create_indexes(self, collection_name: str) -> None:
+        """ Create the declared indexes of a collection, the existing ones are left as they are.
+            An existing index whose uniqueness differs from the declared one (e.g. built by an older version)
+            is dropped and built again. If a unique index can't be built because of duplicates (e.g. left by an older
+            version), the duplicates are deleted first, see `drop_duplicates`.
+        """
+        specs = self.indexes[collection_name]
+        collection = getattr(self, collection_name)
+        models = [IndexModel(spec.keys, unique=spec.unique, background=self.index_background) for spec in specs]
+        with self.timer.stage('create_indexes'):
+            handled_codes = set()
+            while True:
+                try:
+                    names = await collection.create_indexes(models)
+                    break
+                except OperationFailure as err:
+                    if err.code in handled_codes:
+                        raise
+
+                    if err.code in self.index_conflict_codes:
+                        await self.drop_conflicting_indexes(collection_name, models)
+                        handled_codes |= self.index_conflict_codes
+                    elif err.code == self.duplicate_key_code:
+                        for spec in specs:
+                            if spec.unique:
+                                await self.drop_duplicates(collection_name, [key for key, _ in spec.keys])
+                        handled_codes.add(err.code)
+                    else:
+                        raise
+
+        for name, spec in zip(names, specs):
+            self.logger.info('Index %s.%s | serves %s', collection_name, name, spec.serves)
+
+    async def drop_conflicting_indexes(self, collection_name: str, models: list[IndexModel]) -> None:
+        """ Drop the existing indexes whose uniqueness differs from the declared one."""
+        collection = getattr(self, collection_name)
+        existing = await collection.index_information()
+        for model in models:
+            name = model.document['name']
+            unique = model.document.get('unique', False)
+            if name in existing and existing[name].get('unique', False) != unique:
+                self.logger.warning('Index %s.%s | declared uniqueness changed, rebuilding', collection_name, name)
+                await collection.drop_index(name)
+
+    async def drop_duplicates(self, collection_name: str, keys: list[str]) -> None:
+        """ Delete the documents with the same values of `keys`, only the one `updated` last is kept."""
+        collection = getattr(self, collection_name)
+        pipeline = [
+            {'$sort': {'updated': -1}},
+            {'$group': {'_id': {key: f'${key}' for key in keys}, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ]
+        num_of_groups = num_of_deleted = 0
+        async for group in collection.aggregate(pipeline, allowDiskUse=True):
+            result = await collection.delete_many({'_id': {'$in': group['ids'][1:]}})
+            num_of_groups += 1
+            num_of_deleted += result.deleted_count
+
+        self.logger.warning(
+            'Index %s.%s | %d duplicated values, deleted %d documents not updated last',
+            collection_name, '_'.join(keys), num_of_groups, num_of_deleted,
+        )
 
-    async def write_projects(self) -> None:
-        """ Methods that extract project info from challenges."""
+    @staticmethod
+    def match_project_ids(project_ids: typing.Optional[set]) -> dict:
+        """ Match the challenges of the given projects, or of any project if `project_ids` is None."""
+        return {'project_id': {'$ne': None} if project_ids is None else {'$in': list(project_ids)}}
+
+    async def write_projects(self, project_ids: typing.Optional[set] = None) -> None:
+        """ Methods that extract project info from challenges.
+            If `project_ids` is given, only those projects are replaced and the ones without challenges are deleted.
+        """
         count_by_track_cond = {
             f'num_of_challenge_{track}': {
                 '$sum': {'$toInt': {'$eq': ['$track', track]}}
@@ -100,7 +399,7 @@ class TopcoderMongo:
         }
 
         query = [
-            {'$match': {'project_id': {'$ne': None}}},
+            {'$match': self.match_project_ids(project_ids)},
             {
                 '$group': {
                     '_id': '$project_id',
@@ -161,28 +460,72 @@ class TopcoderMongo:
         ]
 
         self.logger.info('Creating project data from challenge data...')
+        with self.timer.stage('write_projects'):
+            with self.timer.step('write_projects.aggregate'):
+                try:
+                    await self.merge_projects(query, project_ids)
+                except OperationFailure as err:
+                    self.logger.warning(
+                        'Server side project aggregation failed, writing from the client instead | %s', err,
+                    )
+                    await self.stream_projects(query, project_ids)
+
+            if project_ids is not None:
+                with self.timer.step('write_projects.delete'):
+                    remaining_ids = await self.challenge.distinct('project_id', self.match_project_ids(project_ids))
+                    result = await self.project.delete_many({
+                        'id': {'$in': list({int(project_id) for project_id in project_ids - set(remaining_ids)})},
+                    })
+                self.logger.info('Deleted %d projects without challenges', result.deleted_count)
+
+    async def merge_projects(self, query: list[dict], project_ids: typing.Optional[set]) -> None:
+        """ Write the aggregated projects on the server side. `$out` replaces the whole collection at once,
+            `$merge` replaces the given projects, it needs the unique index on project id.
+        """
+        stage = (
+            {'$out': self.project.name}
+            if project_ids is None else
+            {'$merge': {'into': self.project.name, 'on': 'id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        )
+        await self.challenge.aggregate([*query, stage], allowDiskUse=True).to_list(None)
+        self.logger.info('Wrote projects with %s', next(iter(stage)))
+
+    async def stream_projects(self, query: list[dict], project_ids: typing.Optional[set]) -> None:
+        """ Write the aggregated projects from the client, in bounded batches as the cursor is read."""
+        if project_ids is None:
+            await self.project.drop()
 
-        project_data = []
-        async for doc in self.challenge.aggregate(query):
+        operations: list[typing.Union[InsertOne, ReplaceOne]] = []
+        num_of_project = 0
+        async for doc in self.challenge.aggregate(query, allowDiskUse=True):
             self.logger.debug(
                 'Project %s | number of challenges: %d',
                 str(doc['id']),
                 doc['num_of_challenge'][-1]['count']
             )
-            project_data.append(doc)
+            operations.append(
+                InsertOne(doc) if project_ids is None else ReplaceOne({'id': doc['id']}, doc, upsert=True)
+            )
+            if len(operations) == self.project_write_batch_size:
+                await self.project.bulk_write(operations, ordered=False)
+                num_of_project += len(operations)
+                operations = []
 
-        await self.project.drop()
-        await self.project.insert_many(project_data)
+        if operations:
+            await self.project.bulk_write(operations, ordered=False)
+            num_of_project += len(operations)
+
+        self.logger.info('Wrote %d projects from the client', num_of_project)
 
-    async def write_project_section_sim(self) -> None:
-        """ Calculate project section text similarity.
+    async def write_project_section_sim(self, project_ids: typing.Optional[set] = None) -> None:
+        """ Calculate project section text similarity, of the given projects only if `project_ids` is given.
             Criteria for section similarity comparison:
             1. The length of text in a section should be greater than 0.
             2. The grouped section texts shoud contain more than 1 document (i.e `len(section_texts) > 1`).
         """
         self.logger.info('Computing section text similarity for projects...')
         query = [
-            {'$match': {'project_id': {'$ne': None}}},
+            {'$match': self.match_project_ids(project_ids)},
             {
                 '$project': {
                     'project_id': {'$toInt': '$project_id'},
@@ -217,77 +560,241 @@ class TopcoderMongo:
             }}},
         ]
 
-        with ThreadPoolExecutor(max_workers=2 ** 10) as executor:  # This is computationally super expensive
-            await asyncio.gather(*[
-                asyncio.create_task(
-                    self.compute_project_section_sim(project, executor),
-                    name='ProjSec-{}-{}'.format(project['project_id'], project['section_name']),
-                ) async for project in self.challenge.aggregate(query)]
+        self.logger.info(
+            'Section similarity executor: %s | workers %d | batch size %d | global idf %s',
+            self.sim_executor, self.sim_workers, self.sim_batch_size, self.global_idf,
+        )
+
+        with self.timer.stage('write_project_section_sim'):
+            with self.timer.step('write_project_section_sim.group'):
+                projects: list[ProjectSection] = [project async for project in self.challenge.aggregate(query)]
+
+            with self.timer.step('write_project_section_sim.tokenize'):
+                tokens_by_key = await self.tokenize_section_texts(projects)
+
+            shared_tfidf = None
+            if self.global_idf:
+                with self.timer.step('write_project_section_sim.fit_tfidf'):
+                    shared_tfidf = fit_tfidf(tokens_by_key.values())
+                self.logger.info('Fitted global tfidf model | vocabulary size %d', len(shared_tfidf[0]))
+
+            # This is computationally super expensive and mostly pure Python, hence processes by default
+            with self.timer.step('write_project_section_sim.compute'), self.sim_executor_cls(
+                max_workers=self.sim_workers,
+                initializer=init_shared_tfidf,
+                initargs=(shared_tfidf,),
+            ) as executor:
+                section_sims = await asyncio.gather(*[
+                    asyncio.create_task(
+                        self.compute_project_section_sim(
+                            projects[idx: idx + self.sim_batch_size], tokens_by_key, executor
+                        ),
+                        name=f'ProjSecBatch-{idx}',
+                    ) for idx in range(0, len(projects), self.sim_batch_size)
+                ])
+
+            section_exprs_by_project: defaultdict[int, list[dict]] = defaultdict(list)
+            for project, section_sim in zip(projects, (sim for batch in section_sims for sim in batch)):
+                section_exprs_by_project[project['project_id']].append({
+                    'name': project['section_name'],
+                    'similarity': section_sim,
+                    # a little hack here
+                    'frequency': {'$divide': [project['section_freq'], {'$max': '$num_of_challenge.count'}]},
+                })
+
+            with self.timer.step('write_project_section_sim.write'):
+                await self.write_section_sim(section_exprs_by_project)
+
+    async def write_section_sim(self, section_exprs_by_project: dict[int, list[dict]]) -> None:
+        """ Set the section similarity of each project with one update, sent in unordered bulk writes."""
+        operations = [
+            UpdateOne({'id': project_id}, [{'$set': {'section_similarity': section_exprs}}])
+            for project_id, section_exprs in section_exprs_by_project.items()
+        ]
+
+        for idx in range(0, len(operations), self.sim_write_batch_size):
+            result = await self.project.bulk_write(operations[idx: idx + self.sim_write_batch_size], ordered=False)
+            self.logger.info(
+                'Updated section similarity of projects %d - %d | matched %d',
+                idx, idx + len(operations[idx: idx + self.sim_write_batch_size]), result.matched_count,
             )
 
-    async def compute_project_section_sim(
+    async def tokenize_section_texts(self, projects: list[ProjectSection]) -> dict[str, list[str]]:
+        """ Tokenize every distinct section text once, reusing the tokens cached by previous runs.
+            The cache is evicted down to `token_cache_size`, unless it's 0 and the cache is disabled.
+            Return the tokens keyed by `token_cache_key` of the text.
+        """
+        texts = {token_cache_key(text): text for project in projects for text in project['section_texts']}
+        if not self.token_cache_size:
+            return await self.tokenize_missing_texts(texts, set())
+
+        token_cache = KeyValueCache(self.cache_dir / self.token_cache_filename, self.token_cache_size)
+        try:
+            tokens_by_key = token_cache.get_many(texts.keys(), touch=True)
+            missing_tokens = await self.tokenize_missing_texts(texts, tokens_by_key.keys())
+            token_cache.set_many(missing_tokens)
+            self.logger.info(
+                'Token cache | evicted %d entries | size %d bytes',
+                token_cache.evict(self.token_cache_size),
+                token_cache.size(),
+            )
+        finally:
+            token_cache.close()
+
+        tokens_by_key.update(missing_tokens)
+        return tokens_by_key
+
+    async def tokenize_missing_texts(
         self,
-        project: ProjectSection,
-        executor: ThreadPoolExecutor,
-    ):
-        """ Compute the section text similarity."""
+        texts: dict[str, str],
+        cached_keys: typing.Collection[str],
+    ) -> dict[str, list[str]]:
+        """ Tokenize the texts not cached in a pool, return their tokens keyed by `token_cache_key` of the text."""
         loop: AbstractEventLoop = asyncio.get_running_loop()
 
-        self.logger.debug('Computing project %d section %s', project['project_id'], project['section_name'])
+        missing_keys = [key for key in texts if key not in cached_keys]
 
-        section_sim = await loop.run_in_executor(executor, compute_section_text_similarity, project['section_texts'])
-        section_expr = {
-            'name': project['section_name'],
-            'similarity': section_sim,
-            'frequency': {'$divide': [project['section_freq'], {'$max': '$num_of_challenge.count'}]},  # a little hack here
-        }
-        await self.project.update_one(
-            {'id': project['project_id']},
-            [
-                {
-                    '$set': {
-                        'section_similarity': {
-                            '$concatArrays':[{'$ifNull': ['$section_similarity', []]}, [section_expr]],
-                        },
-                    },
-                },
-            ],
+        self.logger.info(
+            'Tokenizing section texts | distinct texts %d | cached %d', len(texts), len(cached_keys),
         )
 
-        self.logger.info('Updated project %s section %s sim %f', project['project_id'], project['section_name'], section_sim)
-
-    async def write_challenges(self) -> None:
-        """ Methods for inserting all of the fetch challenges. (Of course we pre-process it before inserting ;-)"""
-        coro_queue = [
-            asyncio.create_task(
-                self.write_challenge_year_page(challenge_lst_file),
-                name='InsertChallenges-year-{}-page-{}'.format(
-                    *map(int, self.regex.match(challenge_lst_file.name).groups())
-                ),
-            ) for challenge_lst_file in self.input_dir.glob('*_challenge_lst.json')
+        batches = [
+            missing_keys[idx: idx + self.tokenize_batch_size]
+            for idx in range(0, len(missing_keys), self.tokenize_batch_size)
         ]
+        with self.sim_executor_cls(max_workers=self.sim_workers) as executor:
+            timed_batches = await asyncio.gather(*[
+                loop.run_in_executor(
+                    executor,
+                    run_timed_step,
+                    self.timer.profile_dir,
+                    'write_project_section_sim',
+                    'tokenize_batch',
+                    tokenize_batch,
+                    [texts[key] for key in batch],
+                ) for batch in batches
+            ])
+
+        tokenized_batches = []
+        for tokenized, timer in timed_batches:
+            tokenized_batches.append(tokenized)
+            self.timer.merge(timer)
+
+        return {
+            key: tokens
+            for batch, tokenized in zip(batches, tokenized_batches)
+            for key, tokens in zip(batch, tokenized)
+        }
+
+    async def compute_project_section_sim(
+        self,
+        projects: list[ProjectSection],
+        tokens_by_key: dict[str, list[str]],
+        executor: Executor,
+    ) -> list[float]:
+        """ Compute the section text similarity of a batch of project sections."""
+        loop: AbstractEventLoop = asyncio.get_running_loop()
+
+        self.logger.debug('Computing %d project sections', len(projects))
+
+        section_sims, timer = await loop.run_in_executor(
+            executor,
+            run_timed_step,
+            self.timer.profile_dir,
+            'write_project_section_sim',
+            'compute_batch',
+            compute_tokenized_section_similarity_batch,
+            [[tokens_by_key[token_cache_key(text)] for text in project['section_texts']] for project in projects],
+        )
+        self.timer.merge(timer)
+
+        for project, section_sim in zip(projects, section_sims):
+            self.logger.debug(
+                'Computed project %s section %s sim %f', project['project_id'], project['section_name'], section_sim
+            )
 
-        await asyncio.gather(*coro_queue)
+        return section_sims
 
-    async def write_challenge_year_page(self, challenge_lst_file: pathlib.Path) -> None:
-        year, page = map(int, self.regex.match(challenge_lst_file.name).groups())
-        self.logger.info('Year %d page %d | Inserting', year, page)
+    @contextlib.contextmanager
+    def preprocess_executor(self) -> typing.Iterator[Executor]:
+        """ Process pool for pre-processing the challenge files, with the description cache opened in every worker.
+            Every worker evicts the cache down to `description_cache_size` as soon as it sees it over it, and it's
+            evicted down to it again once the pool is shut down.
+        """
+        self.logger.info(
+            'Pre-processing challenges | workers %d | pages in flight %d | description cache %d bytes',
+            self.preprocess_workers, self.preprocess_in_flight, self.description_cache_size,
+        )
+        description_cache_path = self.cache_dir / self.description_cache_filename
+        description_cache = self.description_cache_size and KeyValueCache(description_cache_path)
 
-        challenge_lst = []
-        with open(challenge_lst_file) as f:
-            challenge_lst = convert_datetime_json_value(snake_case_json_key(json.load(f)))
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.preprocess_workers,
+                initializer=init_description_cache,
+                initargs=(description_cache and description_cache_path, self.description_cache_size),
+            ) as executor:
+                yield executor
 
-        for challenge in challenge_lst:
-            if 'description' in challenge and 'description_format' in challenge:
-                challenge['processed_description'] = html_to_sectioned_text(
-                    challenge['description']
-                    if challenge['description_format'] == 'HTML' else
-                    markdown.markdown(challenge['description'])
+            if description_cache:
+                self.logger.info(
+                    'Description cache | evicted %d entries | size %d bytes',
+                    description_cache.evict(self.description_cache_size),
+                    description_cache.size(),
                 )
+        finally:
+            if description_cache:
+                description_cache.close()
+
+    async def write_challenges(self, upsert: bool = False) -> set:
+        """ Methods for inserting all of the fetch challenges. (Of course we pre-process it before inserting ;-)
+            The pre-processing is CPU bound, it runs in a process pool and the event loop only inserts.
+            At most `preprocess_in_flight` pages are being processed or inserted at a time.
+            The processed descriptions are cached across runs unless `description_cache_size` is 0.
+            If `upsert`, the challenges replace the ones with the same id. Return the project ids of the written
+            challenges, including the previous project ids of the replaced ones.
+        """
+        in_flight = asyncio.Semaphore(self.preprocess_in_flight)
+        self.inserted_ids = set()
+        with self.timer.stage('write_challenges'), self.preprocess_executor() as executor:
+            coro_queue = [
+                asyncio.create_task(
+                    self.write_challenge_year_page(year, page, executor, in_flight, upsert),
+                    name=f'InsertChallenges-year-{year}-page-{page}',
+                ) for year, page in self.challenge_pages()
+            ]
+
+            project_ids_by_page = await asyncio.gather(*coro_queue)
+
+        return set().union(*project_ids_by_page)
+
+    def challenge_pages(self) -> list[tuple[int, int]]:
+        """ Year and page of the fetched challenge lists, whichever storage format they are in."""
+        storage = open_storage(self.input_dir)
+        try:
+            return storage.pages()
+        finally:
+            storage.close()
+
+    async def write_challenge_year_page(
+        self,
+        year: int,
+        page: int,
+        executor: Executor,
+        in_flight: asyncio.Semaphore,
+        upsert: bool = False,
+    ) -> set:
+        loop: AbstractEventLoop = asyncio.get_running_loop()
+
+        async with in_flight:
+            self.logger.info('Year %d page %d | Inserting', year, page)
+            challenge_lst, timer = await loop.run_in_executor(
+                executor, load_challenge_year_page, self.input_dir, year, page, self.timer.profile_dir,
+            )
+            self.timer.merge(timer)
 
-            if challenge['num_of_registrants'] > 0:
-                with open(self.input_dir / '{}_{}_{}_registrant_lst.json'.format(year, page, challenge['id'])) as f:
-                    challenge['registrant_lst'] = convert_datetime_json_value(snake_case_json_key(json.load(f)))
+            for challenge in challenge_lst:
+                if 'registrant_lst' in challenge:
                     self.logger.debug(
                         'Year %d page %d challenge %s | Read registrant list::%d',
                         year,
@@ -296,5 +803,371 @@ class TopcoderMongo:
                         len(challenge['registrant_lst']),
                     )
 
-        await self.challenge.insert_many(challenge_lst)
-        self.logger.info('Year %d page %d | Inserted %d challenges into mongo', year, page, len(challenge_lst))
+            project_ids = {challenge.get('project_id') for challenge in challenge_lst}
+            if not upsert:
+                new_challenge_lst = [
+                    challenge for challenge in challenge_lst if challenge['id'] not in self.inserted_ids
+                ]
+                self.inserted_ids.update(challenge['id'] for challenge in new_challenge_lst)
+                if len(new_challenge_lst) < len(challenge_lst):
+                    self.logger.warning(
+                        'Year %d page %d | Skipped %d challenges already inserted from another page',
+                        year, page, len(challenge_lst) - len(new_challenge_lst),
+                    )
+
+                if new_challenge_lst:
+                    with self.timer.step('write_challenges.insert'):
+                        await self.challenge.insert_many(new_challenge_lst)
+                self.logger.info(
+                    'Year %d page %d | Inserted %d challenges into mongo', year, page, len(new_challenge_lst),
+                )
+                return project_ids - {None}
+
+            with self.timer.step('write_challenges.upsert'):
+                async for challenge in self.challenge.find(
+                    {'id': {'$in': [challenge['id'] for challenge in challenge_lst]}},
+                    {'_id': False, 'project_id': True},
+                ):
+                    project_ids.add(challenge.get('project_id'))
+
+                result = await self.challenge.bulk_write(
+                    [ReplaceOne({'id': challenge['id']}, challenge, upsert=True) for challenge in challenge_lst],
+                    ordered=False,
+                )
+            self.logger.info(
+                'Year %d page %d | Upserted %d challenges into mongo | replaced %d | new %d',
+                year, page, len(challenge_lst), result.matched_count, result.upserted_count,
+            )
+            return project_ids - {None}
+
+    async def upload_shards(
+        self,
+        run_id: str,
+        worker_id: str,
+        lease_seconds: int = 300,
+        shard_attempts: int = 3,
+    ) -> None:
+        """ Upload the challenge files as one of the workers of a sharded run.
+            Every `{year}_{page}` challenge list is a shard, the workers sharing the `run_id` claim the shards
+            through leases in MongoDB and upsert them. All workers must see the same input directory.
+            A shard that failed, or whose lease expired (dead worker), is claimed again until it's been claimed
+            `shard_attempts` times, then it's given up.
+            Once all shards are done or given up, one of the workers recomputes the projects of the upserted
+            challenges.
+        """
+        start_upload = datetime.now()
+        for collection_name in self.indexes:
+            await self.create_indexes(collection_name)
+
+        shards = [f'{year}_{page}' for year, page in self.challenge_pages()]
+        await self.lease.bulk_write([
+            UpdateOne(
+                {'_id': f'{run_id}:{shard}'},
+                {'$setOnInsert': {'run_id': run_id, 'kind': kind, 'shard': shard, 'state': 'pending'}},
+                upsert=True,
+            ) for kind, shard in [*(('shard', shard) for shard in shards), ('finalize', 'finalize')]
+        ], ordered=False)
+        self.logger.info('Run %s worker %s | %d shards in the input directory', run_id, worker_id, len(shards))
+
+        in_flight = asyncio.Semaphore(self.preprocess_in_flight)
+        with self.timer.stage('write_challenges'), self.preprocess_executor() as executor:
+            while True:
+                await asyncio.gather(*[
+                    self.claim_shards(run_id, worker_id, lease_seconds, shard_attempts, executor, in_flight)
+                    for _ in range(self.preprocess_in_flight)
+                ])
+
+                num_of_leased = await self.lease.count_documents(self.match_unfinished_shards(run_id, shard_attempts))
+                if num_of_leased == 0:
+                    break
+
+                self.logger.info('Run %s | waiting for %d shards leased by other workers', run_id, num_of_leased)
+                await asyncio.sleep(self.lease_poll_interval)
+
+        given_up = [
+            lease['shard'] async for lease in self.lease.find(
+                {'run_id': run_id, 'kind': 'shard', 'state': {'$ne': 'done'}}, {'shard': True},
+            )
+        ]
+        if given_up:
+            self.logger.error(
+                'Run %s | %d shards given up after %d attempts: %s',
+                run_id, len(given_up), shard_attempts, ', '.join(sorted(given_up)),
+            )
+
+        await self.finalize_shards(run_id, worker_id, lease_seconds)
+        self.logger.info(
+            'Run %s worker %s | finished, total time used: %d seconds',
+            run_id, worker_id, (datetime.now() - start_upload).total_seconds(),
+        )
+        self.timer.report(self.logger)
+
+    @staticmethod
+    def match_unfinished_shards(run_id: str, shard_attempts: int) -> dict:
+        """ Match the shards of the run that are not done yet and not given up."""
+        return {
+            'run_id': run_id,
+            'kind': 'shard',
+            '$or': [
+                {'state': 'pending'},
+                {
+                    'state': 'leased',
+                    '$or': [
+                        {'lease_until': {'$gte': datetime.now(timezone.utc)}},
+                        {'attempts': {'$not': {'$gte': shard_attempts}}},
+                    ],
+                },
+                {'state': 'failed', 'attempts': {'$not': {'$gte': shard_attempts}}},
+            ],
+        }
+
+    async def claim_lease(
+        self,
+        run_id: str,
+        kind: str,
+        worker_id: str,
+        lease_seconds: int,
+        max_attempts: typing.Optional[int] = None,
+    ) -> typing.Optional[dict]:
+        """ Claim a pending, expired or failed lease of the run. Return the lease as it was before the claim.
+            With `max_attempts`, an expired or failed lease already claimed that many times is not claimed again.
+        """
+        now = datetime.now(timezone.utc)
+        retry = {} if max_attempts is None else {'attempts': {'$not': {'$gte': max_attempts}}}  # Or no attempts yet
+        return await self.lease.find_one_and_update(
+            {
+                'run_id': run_id,
+                'kind': kind,
+                '$or': [
+                    {'state': 'pending'},
+                    {'state': 'leased', 'lease_until': {'$lt': now}, **retry},
+                    {'state': 'failed', **retry},
+                ],
+            },
+            {
+                '$set': {
+                    'state': 'leased',
+                    'worker_id': worker_id,
+                    'lease_until': now + timedelta(seconds=lease_seconds),
+                },
+                '$inc': {'attempts': 1},
+            },
+            sort=[('shard', ASCENDING)],
+        )
+
+    @contextlib.asynccontextmanager
+    async def hold_lease(self, lease: dict, worker_id: str, lease_seconds: int) -> typing.AsyncIterator[None]:
+        """ Renew the lease in the background while the work is in progress."""
+        if lease['state'] == 'leased':
+            self.logger.warning(
+                'Lease %s | expired lease of worker %s claimed again', lease['_id'], lease['worker_id'],
+            )
+        elif lease['state'] == 'failed':
+            self.logger.warning(
+                'Lease %s | failed on worker %s, claimed again | %s', lease['_id'], lease['worker_id'], lease['error'],
+            )
+
+        async def renew() -> None:
+            while True:
+                await asyncio.sleep(lease_seconds / 3)
+                await self.lease.update_one(
+                    {'_id': lease['_id'], 'worker_id': worker_id},
+                    {'$set': {'lease_until': datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)}},
+                )
+
+        renew_task = asyncio.create_task(renew(), name=f'RenewLease-{lease["_id"]}')
+        try:
+            yield
+        finally:
+            renew_task.cancel()
+
+    async def complete_lease(self, lease: dict, worker_id: str, **fields) -> None:
+        result = await self.lease.update_one(
+            {'_id': lease['_id'], 'worker_id': worker_id},
+            {'$set': {'state': 'done', 'finished_at': datetime.now(timezone.utc), **fields}},
+        )
+        if result.matched_count == 0:
+            self.logger.warning('Lease %s | claimed by another worker before it was done', lease['_id'])
+
+    async def fail_lease(self, lease: dict, worker_id: str, err: Exception) -> None:
+        await self.lease.update_one(
+            {'_id': lease['_id'], 'worker_id': worker_id},
+            {'$set': {'state': 'failed', 'finished_at': datetime.now(timezone.utc), 'error': repr(err)}},
+        )
+
+    async def claim_shards(
+        self,
+        run_id: str,
+        worker_id: str,
+        lease_seconds: int,
+        shard_attempts: int,
+        executor: Executor,
+        in_flight: asyncio.Semaphore,
+    ) -> None:
+        """ Upsert the shards one by one until there is none to claim.
+            A shard that can't be written (e.g. a corrupt file) is marked as failed for another worker to try.
+        """
+        while (lease := await self.claim_lease(run_id, 'shard', worker_id, lease_seconds, shard_attempts)) is not None:
+            try:
+                async with self.hold_lease(lease, worker_id, lease_seconds):
+                    year, page = map(int, lease['shard'].split('_'))
+                    project_ids = await self.write_challenge_year_page(year, page, executor, in_flight, upsert=True)
+            except Exception as err:
+                self.logger.exception('Lease %s | failed | attempt %d', lease['_id'], lease.get('attempts', 0) + 1)
+                await self.fail_lease(lease, worker_id, err)
+                continue
+
+            await self.complete_lease(lease, worker_id, project_ids=list(project_ids))
+
+    async def finalize_shards(self, run_id: str, worker_id: str, lease_seconds: int) -> None:
+        """ Recompute the projects of the challenges upserted by all workers, it's done by one of them."""
+        while (lease := await self.claim_lease(run_id, 'finalize', worker_id, lease_seconds)) is None:
+            finalize = await self.lease.find_one({'_id': f'{run_id}:finalize'})
+            if finalize['state'] == 'done':
+                self.logger.info('Run %s | projects updated by worker %s', run_id, finalize['worker_id'])
+                return
+
+            await asyncio.sleep(self.lease_poll_interval)
+
+        async with self.hold_lease(lease, worker_id, lease_seconds):
+            project_ids = set(await self.lease.distinct('project_ids', {'run_id': run_id, 'kind': 'shard'}))
+            self.logger.info('Run %s | updating %d projects of the upserted challenges', run_id, len(project_ids))
+            if project_ids:
+                await self.write_projects(project_ids)
+                await self.write_project_section_sim(project_ids)
+
+        await self.complete_lease(lease, worker_id)
+
+
+class ChallengeStreamWriter:
+    """ Stream fetched pages into MongoDB without the intermediate JSON files.
+        fetcher --(raw queue)--> process (in a process pool) --(document queue)--> batched bulk write
+        Both queues are bounded, so a slow stage pushes back on the stage before it.
+        The pages are normalized and sectionized by `workers` processes, one page each at a time.
+        Writes are upserts by challenge id, so a registrant list may arrive before its challenge.
+    """
+    challenge = TopcoderMongo.challenge
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        queue_size: int = 16,
+        batch_size: int = 500,
+        workers: typing.Optional[int] = None,
+    ) -> None:
+        self.logger = logger
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+
+        self.raw_queue: typing.Optional[asyncio.Queue] = None
+        self.document_queue: typing.Optional[asyncio.Queue] = None
+        self.executor: typing.Optional[ProcessPoolExecutor] = None
+        self.processors: list[asyncio.Task] = []
+        self.writer: typing.Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> 'ChallengeStreamWriter':
+        self.raw_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.document_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.processors = [
+            asyncio.create_task(self.process(), name=f'StreamProcess-{idx}') for idx in range(self.workers)
+        ]
+        self.writer = asyncio.create_task(self.write(), name='StreamWrite')
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        try:
+            for _ in self.processors:
+                await self.raw_queue.put(None)
+            await asyncio.gather(*self.processors)
+            await self.document_queue.put(None)
+            await self.writer
+        finally:
+            self.executor.shutdown()
+
+    async def put_challenge_lst(
+        self,
+        year: int,
+        page: int,
+        challenge_lst: list[dict],
+        on_written: typing.Callable[[], None],
+    ) -> None:
+        """ `on_written` is called once the page is in the database."""
+        await self.raw_queue.put(('challenge', None, f'Year {year} page {page}', challenge_lst, on_written))
+
+    async def put_registrant_lst(
+        self,
+        year: int,
+        page: int,
+        challenge_id: str,
+        registrant_lst: list[dict],
+        on_written: typing.Callable[[], None],
+    ) -> None:
+        """ `on_written` is called once the registrant list is in the database."""
+        label = f'Year {year} page {page} challenge {challenge_id}'
+        await self.raw_queue.put(('registrant', challenge_id, label, registrant_lst, on_written))
+
+    async def drain(self) -> None:
+        """ Wait until everything put in the stream is written (or failed)."""
+        await self.raw_queue.join()
+        await self.document_queue.join()
+
+    async def process(self) -> None:
+        """ Convert raw pages into write operations in the process pool."""
+        loop: AbstractEventLoop = asyncio.get_running_loop()
+
+        while (item := await self.raw_queue.get()) is not None:
+            kind, challenge_id, label, raw_lst, on_written = item
+            try:
+                if kind == 'challenge':
+                    challenge_lst = await loop.run_in_executor(self.executor, process_challenge_lst, raw_lst)
+                    operations = [
+                        UpdateOne({'id': challenge['id']}, {'$set': challenge}, upsert=True)
+                        for challenge in challenge_lst
+                    ]
+                else:
+                    registrant_lst = await loop.run_in_executor(self.executor, process_registrant_lst, raw_lst)
+                    operations = [
+                        UpdateOne({'id': challenge_id}, {'$set': {'registrant_lst': registrant_lst}}, upsert=True)
+                    ]
+            except Exception:
+                self.logger.exception('%s | Processing failed', label)
+            else:
+                await self.document_queue.put((label, operations, on_written))
+            finally:
+                self.raw_queue.task_done()
+
+        self.raw_queue.task_done()
+
+    async def write(self) -> None:
+        """ Buffer the operations and flush them when the batch is full or there is nothing else to wait for."""
+        buffer: list[tuple[str, list[UpdateOne], typing.Callable[[], None]]] = []
+
+        while (item := await self.document_queue.get()) is not None:
+            buffer.append(item)
+            if sum(len(operations) for _, operations, _ in buffer) >= self.batch_size or self.document_queue.empty():
+                await self.flush(buffer)
+                buffer = []
+
+        await self.flush(buffer)
+        self.document_queue.task_done()
+
+    async def flush(self, buffer: list[tuple[str, list[UpdateOne], typing.Callable[[], None]]]) -> None:
+        if not buffer:
+            return
+
+        try:
+            await self.challenge.bulk_write(
+                [operation for _, operations, _ in buffer for operation in operations],
+                ordered=False,
+            )
+        except Exception:  # A dead stage would block the whole stream, the items are left in the journal to resume
+            self.logger.exception('Stream | Writing %d items failed', len(buffer))
+        else:
+            for label, operations, on_written in buffer:
+                on_written()
+                self.logger.info('%s | Streamed %d documents into mongo', label, len(operations))
+        finally:
+            for _ in buffer:
+                self.document_queue.task_done()
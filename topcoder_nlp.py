@@ -4,13 +4,19 @@
     out of the scope for this file.
 """
 import typing
+import hashlib
+import numpy as np
+from scipy import sparse
 from collections.abc import Sequence
-from gensim import corpora, utils, models
-from gensim.similarities import SparseMatrixSimilarity
+from gensim import corpora, utils, models, matutils
 from gensim.parsing.preprocessing import STOPWORDS as GENSIM_STOPWORDS
 
 
 STOPWORDS = GENSIM_STOPWORDS - {'computer'}
+TOKENIZER_VERSION = 'simple_preprocess-max_len_20-v1'  # Bump it when `tokenize` changes to invalidate cached tokens
+
+# Tfidf model fitted on the whole corpus, set in each worker by `init_shared_tfidf`
+SHARED_TFIDF: typing.Optional[tuple[corpora.Dictionary, models.TfidfModel]] = None
 
 
 def tokenize(s: str) -> list[str]:
@@ -18,18 +24,69 @@ def tokenize(s: str) -> list[str]:
     return [w for w in utils.simple_preprocess(s, max_len=20) if w not in STOPWORDS]
 
 
-def compute_section_text_similarity(corpus: Sequence[str]):
-    """ Convert text bundle into tfidf vectors."""
-    # Use generator to increase memory efficiency
-    def tokenized_corpus() -> typing.Generator[list[str], None, None]:
-        yield from (tokenize(doc) for doc in corpus)
+def tokenize_batch(corpus: Sequence[str]) -> list[list[str]]:
+    return [tokenize(doc) for doc in corpus]
+
+
+def token_cache_key(s: str) -> str:
+    """ Key of the tokens of a text in the token cache."""
+    return hashlib.sha1(f'{TOKENIZER_VERSION}\0{s}'.encode('utf-8')).hexdigest()
+
+
+def fit_tfidf(tokenized_corpus: typing.Iterable[list[str]]) -> tuple[corpora.Dictionary, models.TfidfModel]:
+    """ The idf is computed from the document frequencies collected by the dictionary."""
+    word_id_map = corpora.Dictionary(tokenized_corpus)
+    return word_id_map, models.TfidfModel(dictionary=word_id_map)
+
+
+def init_shared_tfidf(shared_tfidf: typing.Optional[tuple[corpora.Dictionary, models.TfidfModel]]) -> None:
+    """ Initializer of the executor workers."""
+    global SHARED_TFIDF
+    SHARED_TFIDF = shared_tfidf
+
+
+def compute_section_text_similarity(corpus: Sequence[str]) -> float:
+    """ Convert text bundle into tfidf vectors and average the cosine similarity of every pair of documents."""
+    return compute_tokenized_section_similarity([tokenize(doc) for doc in corpus])
+
+
+def compute_tokenized_section_similarity(
+    tokenized_corpus: Sequence[list[str]],
+    word_id_map: typing.Optional[corpora.Dictionary] = None,
+    tfidf: typing.Optional[models.TfidfModel] = None,
+) -> float:
+    """ Average the cosine similarity of every pair of tokenized documents.
+        The tfidf model is fitted on the documents themselves unless a (global) one is given.
+    """
+    if word_id_map is None or tfidf is None:
+        word_id_map, tfidf = fit_tfidf(tokenized_corpus)
+
+    # term x document sparse matrix
+    tfidf_matrix = matutils.corpus2csc(
+        tfidf[[word_id_map.doc2bow(doc) for doc in tokenized_corpus]],
+        num_terms=len(word_id_map),
+        num_docs=len(tokenized_corpus),
+        dtype=np.float64,
+    )
+    return mean_pairwise_cosine_similarity(tfidf_matrix)
+
+
+def mean_pairwise_cosine_similarity(doc_matrix: sparse.csc_matrix) -> float:
+    """ Mean cosine similarity of the upper triangle of the similarity matrix of the document (column) vectors.
+        Empty documents are zero vectors and have zero similarity with everything, as in `SparseMatrixSimilarity`.
+    """
+    num_docs = doc_matrix.shape[1]
+    norms = np.sqrt(np.asarray(doc_matrix.multiply(doc_matrix).sum(axis=0)).ravel())
+    unit_matrix = doc_matrix @ sparse.diags(np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0))
 
-    def bag_of_words_corpus(dct: corpora.Dictionary) -> typing.Generator[list[tuple[int, int]], None, None]:
-        yield from (dct.doc2bow(doc) for doc in tokenized_corpus())
+    vector_sum = np.asarray(unit_matrix.sum(axis=1)).ravel()
+    self_similarity = np.count_nonzero(norms)
+    return float((vector_sum @ vector_sum - self_similarity) / (num_docs * (num_docs - 1)))
 
-    word_id_map = corpora.Dictionary(tokenized_corpus())
-    tfidf = models.TfidfModel(bag_of_words_corpus(word_id_map), dictionary=word_id_map)
 
-    similarity_index = SparseMatrixSimilarity(tfidf[bag_of_words_corpus(word_id_map)], num_features=len(word_id_map))
-    pairwise_similarity = [simi for idx, similarities in enumerate(similarity_index) for simi in similarities[idx + 1:]]
-    return sum(pairwise_similarity) / len(pairwise_similarity)
+def compute_tokenized_section_similarity_batch(tokenized_corpora: Sequence[Sequence[list[str]]]) -> list[float]:
+    """ Compute the similarity of many sections in one go, so that the cost of sending
+        a task to another process is shared by the sections. Use the shared tfidf model if there is one.
+    """
+    word_id_map, tfidf = SHARED_TFIDF or (None, None)
+    return [compute_tokenized_section_similarity(corpus, word_id_map, tfidf) for corpus in tokenized_corpora]
@@ -0,0 +1,204 @@
+""" Columnar export of the challenges and their registrants into Parquet files."""
+import json
+import shutil
+import typing
+import logging
+import pathlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime
+from collections import defaultdict
+from util import normalize_json_object
+from storage import open_storage
+
+TIMESTAMP = pa.timestamp('ms', tz='UTC')
+
+# The partition columns `year` (of the end date, as the fetcher divides the challenges) and `track`
+# are encoded in the directory names, e.g. `challenge/year=2020/track=Development/part-0.parquet`.
+# A challenge without end date yet (New, Draft) is partitioned by its start date, or its creation date.
+CHALLENGE_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('legacy_id', pa.int64()),
+    ('project_id', pa.int64()),
+    ('name', pa.string()),
+    ('type', pa.string()),
+    ('status', pa.string()),
+    ('tags', pa.list_(pa.string())),
+    ('created', TIMESTAMP),
+    ('updated', TIMESTAMP),
+    ('start_date', TIMESTAMP),
+    ('end_date', TIMESTAMP),
+    ('num_of_registrants', pa.int64()),
+    ('num_of_submissions', pa.int64()),
+    ('total_prize', pa.float64()),
+    ('prize_sets', pa.string()),  # JSON encoded, the nesting differs between challenge types
+    ('description_format', pa.string()),
+    ('description', pa.string()),
+])
+REGISTRANT_SCHEMA = pa.schema([
+    ('challenge_id', pa.string()),
+    ('id', pa.string()),
+    ('member_id', pa.string()),  # A string in the resources API, as are the other ids
+    ('member_handle', pa.string()),
+    ('role_id', pa.string()),
+    ('created', TIMESTAMP),
+])
+
+
+def challenge_row(challenge: dict) -> dict:
+    """ Flatten a challenge normalized by `normalize_json` into a row of `CHALLENGE_SCHEMA`."""
+    row = {name: challenge.get(name) for name in CHALLENGE_SCHEMA.names}
+    row['total_prize'] = (challenge.get('overview') or {}).get('total_prizes')
+    if row['total_prize'] is None and challenge.get('prize_sets'):
+        row['total_prize'] = sum(
+            prize.get('value') or 0
+            for prize_set in challenge['prize_sets'] if prize_set.get('type') == 'placement'
+            for prize in prize_set.get('prizes', [])
+        )
+    row['prize_sets'] = challenge.get('prize_sets') and json.dumps(challenge['prize_sets'], default=str)
+    return row
+
+
+def registrant_row(challenge_id: str, registrant: dict) -> dict:
+    row = {**{name: registrant.get(name) for name in REGISTRANT_SCHEMA.names}, 'challenge_id': challenge_id}
+    if row['member_id'] is not None:
+        row['member_id'] = str(row['member_id'])
+
+    return row
+
+
+def partition_year(challenge: dict) -> int:
+    return (challenge.get('end_date') or challenge.get('start_date') or challenge['created']).year
+
+
+class ParquetExporter:
+    """ Write the challenges and registrants into Parquet datasets partitioned by year and track.
+        Rows are buffered per partition and written as a row group once there are `row_group_size` of them,
+        so only one row group per partition is held in memory however many challenges are exported.
+    """
+    tables = {'challenge': CHALLENGE_SCHEMA, 'registrant': REGISTRANT_SCHEMA}
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        output_dir: pathlib.Path,
+        compression: str = 'zstd',
+        row_group_size: int = 10000,
+    ) -> None:
+        self.logger = logger
+        self.output_dir = output_dir
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.buffers: dict[tuple[str, int, str], list[dict]] = defaultdict(list)
+        self.writers: dict[tuple[str, int, str], pq.ParquetWriter] = {}
+        self.num_of_rows: dict[str, int] = defaultdict(int)
+
+    def __enter__(self) -> 'ParquetExporter':
+        for table in self.tables:
+            if (self.output_dir / table).exists():
+                self.logger.info('Removing the previous export %s', self.output_dir / table)
+                shutil.rmtree(self.output_dir / table)
+
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for partition in list(self.buffers):
+            self.flush(partition)
+
+        for writer in self.writers.values():
+            writer.close()
+
+        self.logger.info(
+            'Exported %s into %d files in %s',
+            ', '.join(f'{count} {table}s' for table, count in self.num_of_rows.items()),
+            len(self.writers),
+            self.output_dir,
+        )
+
+    def add_challenges(self, challenge_lst: list[dict]) -> None:
+        """ Add challenges normalized by `normalize_json`, with their `registrant_lst` if any."""
+        for challenge in challenge_lst:
+            year, track = partition_year(challenge), challenge.get('track') or 'Unknown'
+            self.add_row(('challenge', year, track), challenge_row(challenge))
+            for registrant in challenge.get('registrant_lst') or []:
+                self.add_row(('registrant', year, track), registrant_row(challenge['id'], registrant))
+
+    def add_row(self, partition: tuple[str, int, str], row: dict) -> None:
+        self.buffers[partition].append(row)
+        if len(self.buffers[partition]) >= self.row_group_size:
+            self.flush(partition)
+
+    def flush(self, partition: tuple[str, int, str]) -> None:
+        """ Write the buffered rows of a partition as a row group."""
+        rows = self.buffers.pop(partition, None)
+        if not rows:
+            return
+
+        table, year, track = partition
+        schema = self.tables[table]
+        if partition not in self.writers:
+            path = self.output_dir / table / f'year={year}' / f'track={track}' / 'part-0.parquet'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.writers[partition] = pq.ParquetWriter(str(path), schema, compression=self.compression)
+
+        self.writers[partition].write_table(
+            pa.Table.from_pydict({name: [row[name] for row in rows] for name in schema.names}, schema=schema)
+        )
+        self.num_of_rows[table] += len(rows)
+
+
+def read_challenge_files(input_dir: pathlib.Path) -> typing.Iterator[list[dict]]:
+    """ Yield the fetched challenge pages in the input directory with their registrant lists attached."""
+    storage = open_storage(input_dir)
+    try:
+        for year, page in storage.pages():
+            challenge_lst = storage.read_challenge_lst(year, page, normalize_json_object)
+            for challenge in challenge_lst:
+                if challenge.get('num_of_registrants', 0) > 0:
+                    challenge['registrant_lst'] = storage.read_registrant_lst(
+                        year, page, challenge['id'], normalize_json_object,
+                    )
+
+            yield challenge_lst
+    finally:
+        storage.close()
+
+
+async def read_challenge_collection(batch_size: int = 1000) -> typing.AsyncIterator[list[dict]]:
+    """ Yield the challenges in the `challenge` collection in batches."""
+    from topcoder_mongo import get_collection
+
+    projection = {
+        '_id': False,
+        'track': True,
+        'registrant_lst': True,
+        'overview': True,
+        **{name: True for name in CHALLENGE_SCHEMA.names},
+    }
+    challenge_lst = []
+    async for challenge in get_collection('challenge').find({}, projection, batch_size=batch_size):
+        challenge_lst.append(challenge)
+        if len(challenge_lst) >= batch_size:
+            yield challenge_lst
+            challenge_lst = []
+
+    if challenge_lst:
+        yield challenge_lst
+
+
+def export_from_files(exporter: ParquetExporter, input_dir: pathlib.Path) -> None:
+    start = datetime.now()
+    with exporter:
+        for challenge_lst in read_challenge_files(input_dir):
+            exporter.add_challenges(challenge_lst)
+
+    exporter.logger.info('Export from %s | total time used: %d seconds', input_dir, (datetime.now() - start).seconds)
+
+
+async def export_from_mongo(exporter: ParquetExporter) -> None:
+    start = datetime.now()
+    with exporter:
+        async for challenge_lst in read_challenge_collection():
+            exporter.add_challenges(challenge_lst)
+
+    exporter.logger.info('Export from mongo | total time used: %d seconds', (datetime.now() - start).seconds)
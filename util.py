@@ -1,15 +1,22 @@
 """ Utility functions"""
 import os
 import re
+import json
+import time
+import typing
 import logging
+import markdown
 import pathlib
+import sqlite3
+import functools
 from glob import iglob
 from collections import defaultdict
 from dateutil.parser import isoparse
 from datetime import datetime, timezone
-from bs4 import BeautifulSoup, NavigableString, Tag, PageElement
+from html.parser import HTMLParser
 
 CAMEL_CASE_REGEX = re.compile(r'(?<!^)(?=[A-Z])')
+ISO_DATETIME_REGEX = re.compile(r'^\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}|$)')
 
 
 def init_logger(log_dir: pathlib.Path, log_name: str, debug: bool) -> logging.Logger:
@@ -30,33 +37,183 @@ def init_logger(log_dir: pathlib.Path, log_name: str, debug: bool) -> logging.Lo
     return logger
 
 
-def snake_case_json_key(obj):
-    """ When loading json into python, the dictionary/list of dictionary can be
-        camelCase-keyed. we should convert it before further process/usage.
+class KeyValueCache:
+    """ A persistent cache of JSON serializable values in a SQLite file.
+        With `max_bytes`, the least recently used entries are evicted by `set_many` as soon as the cache grows over
+        it, down to `evict_ratio` of it so that the next writes don't evict again right away.
+        The pages freed by the evictions are given back to the file system (incremental auto vacuum).
     """
-    if not isinstance(obj, (list, dict)):
-        return obj
+    max_variables = 500  # SQLite limits the number of host parameters in a statement
+    # The hits are touched in batches, at most this many keys or seconds after the first pending one
+    touch_batch_size = 500
+    touch_interval = 5.0
+    evict_ratio = 0.9
 
-    if isinstance(obj, list):
-        return [snake_case_json_key(o) for o in obj]
+    def __init__(self, path: pathlib.Path, max_bytes: typing.Optional[int] = None) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')  # only applies to a new file, or after a VACUUM
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')  # a crash can only lose the last commits, not corrupt it
+        self.touched: dict[str, float] = {}  # time of the hits not written yet
+        self.touched_since = 0.0
+        self.approx_size: typing.Optional[int] = None  # size of the entries, counted since the last `size`
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:  # a cache created by an older version
+            self.conn.execute('VACUUM')
+
+        with self.conn:
+            self.conn.execute(
+                """ CREATE TABLE IF NOT EXISTS cache (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """
+            )
+
+    def close(self) -> None:
+        self.flush_touched()
+        self.conn.close()
+
+    def get_many(
+        self,
+        keys: typing.Iterable[str],
+        touch: bool = False,
+        max_age: typing.Optional[float] = None,
+    ) -> dict[str, typing.Any]:
+        """ Return the cached values of the keys, missing keys are left out.
+            If `touch`, the hits count as recently used for `evict`, they are written in batches by `flush_touched`.
+            If `max_age`, the values set more than `max_age` seconds ago are left out as well.
+        """
+        keys, cached = list(keys), {}
+        min_updated_at = time.time() - max_age if max_age is not None else 0
+        for idx in range(0, len(keys), self.max_variables):
+            chunk = keys[idx: idx + self.max_variables]
+            cached.update(
+                (key, json.loads(value)) for key, value in self.conn.execute(
+                    'SELECT key, value FROM cache WHERE updated_at >= ? AND key IN ({})'.format(
+                        ', '.join('?' * len(chunk))
+                    ),
+                    [min_updated_at, *chunk],
+                )
+            )
+
+        if touch and cached:
+            now = time.time()
+            if not self.touched:
+                self.touched_since = now
+            self.touched.update(dict.fromkeys(cached, now))
+            if len(self.touched) >= self.touch_batch_size or now - self.touched_since >= self.touch_interval:
+                self.flush_touched()
+
+        return cached
+
+    def flush_touched(self) -> None:
+        """ Write the pending hits of `get_many` in one transaction."""
+        if not self.touched:
+            return
+
+        with self.conn:
+            self.write_touched()
+
+    def write_touched(self) -> None:
+        self.conn.executemany(
+            'UPDATE cache SET updated_at = MAX(updated_at, ?) WHERE key = ?',
+            [(updated_at, key) for key, updated_at in self.touched.items()],
+        )
+        self.touched = {}
+
+    def set_many(self, items: typing.Mapping[str, typing.Any]) -> None:
+        now = time.time()
+        with self.conn:
+            self.write_touched()
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, updated_at) VALUES (?, ?, ?)',
+                [(key, json.dumps(value), now) for key, value in items.items()],
+            )
+
+        if self.max_bytes is not None:
+            if self.approx_size is None:
+                self.approx_size = self.size()
+            else:  # a replaced entry is counted again, the size is only computed again on eviction
+                self.approx_size += sum(len(key) + len(json.dumps(value)) for key, value in items.items())
+            if self.approx_size > self.max_bytes:
+                self.evict(int(self.max_bytes * self.evict_ratio))
+
+    def size(self) -> int:
+        """ Size of the cached keys and values in bytes (roughly, the text is counted in characters)."""
+        return self.conn.execute('SELECT COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) FROM cache').fetchone()[0]
+
+    def evict(self, max_bytes: int) -> int:
+        """ Delete the least recently used entries until the cache fits in `max_bytes`, and shrink the file.
+            Return the number deleted.
+        """
+        with self.conn:
+            self.write_touched()
+            num_of_deleted = self.conn.execute(
+                """ DELETE FROM cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(LENGTH(key) + LENGTH(value)) OVER (
+                                ORDER BY updated_at DESC, key
+                            ) AS cumulative_size
+                            FROM cache
+                        ) WHERE cumulative_size > ?
+                    )
+                """,
+                (max_bytes,),
+            ).rowcount
+
+        self.conn.executescript('PRAGMA incremental_vacuum;')  # `execute` would only step it, freeing one page
+        self.approx_size = None
+        self.evicted += num_of_deleted
+        return num_of_deleted
 
-    return {CAMEL_CASE_REGEX.sub('_', k).lower(): snake_case_json_key(v) for k, v in obj.items()}
 
+@functools.lru_cache(maxsize=2 ** 12)
+def snake_case_key(key: str) -> str:
+    """ The same handful of camelCase keys repeat in every document, so the conversion is memoized."""
+    return CAMEL_CASE_REGEX.sub('_', key).lower()
+
+
+def normalize_json_value(value):
+    """ Convert the ISO-8601 datetime string (also in a list) to datetime object.
+        Only strings looking like a date are parsed, dictionaries are left as they are.
+    """
+    if isinstance(value, str):
+        if ISO_DATETIME_REGEX.match(value) is None:
+            return value
 
-def convert_datetime_json_value(obj):
-    """ Convert the ISO-8601 datetime string to datetime object."""
-    if not isinstance(obj, (list, dict)):
         try:
-            dt = isoparse(obj)
-        except (ValueError, TypeError):
-            return obj
-        else:
-            return dt
+            return isoparse(value)
+        except ValueError:
+            return value
+
+    if isinstance(value, list):
+        return [normalize_json_value(v) for v in value]
+
+    return value
+
+
+def normalize_json_object(obj: dict) -> dict:
+    """ When loading json into python, the dictionary/list of dictionary can be camelCase-keyed
+        and the datetime values are strings. Convert both in a single pass.
+        It's meant to be the `object_hook` of `json.load`, i.e. the nested dictionaries
+        are already normalized when the hook is called on the outer one.
+    """
+    return {snake_case_key(k): normalize_json_value(v) for k, v in obj.items()}
+
+
+def normalize_json(obj):
+    """ Normalize an already loaded json object, see `normalize_json_object`."""
+    if isinstance(obj, dict):
+        return {snake_case_key(k): normalize_json(v) for k, v in obj.items()}
 
     if isinstance(obj, list):
-        return [convert_datetime_json_value(o) for o in obj]
+        return [normalize_json(o) for o in obj]
 
-    return {k: convert_datetime_json_value(v) for k, v in obj.items()}
+    return normalize_json_value(obj)
 
 
 def get_sorted_filenames(path, name_pattern):
@@ -83,39 +240,163 @@ def datetime_to_isoformat(dt: datetime):
     return '{}Z'.format(dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3])
 
 
-def html_to_sectioned_text(html: str) -> list[dict]:
-    """ Rules for sectionize the text:
+class SectionedTextParser(HTMLParser):
+    """ Sectionize the text of a HTML document in one pass over the parsing events.
+        Rules for sectionize the text:
         - An h tag owns all the next_siblings text until there is another h tag
         - An h tag owns all the children text until there is a child h tag
-        - If a tag has no h tag in its children, it's the end node
+        - If a tag has no h tag in its children, it's the end node, all of its text is one piece
+        The last rule can only be decided when a tag is closed, so the pieces of text of a tag
+        are kept until then and either handed to its parent or replaced by the full text of the tag.
+        Links count as plain text and images are ignored.
+        It gives the same output as the BeautifulSoup (4.9.3, `html.parser`) tree walk it replaces: consecutive text
+        is one string, comments, declarations, processing instructions and any string in `<script>`, `<style>` or
+        `<template>` are pieces of text of their own but not part of the full text of a tag.
     """
-    sectioned_text = defaultdict(list)
-    section_name, section_lvl = 'null', 0
-    h_tag_regex = re.compile(r'^h[1-6]')
-    def go_down_html_tree(node: PageElement, section_name: str, section_lvl: int):
-        """ Recursively parsing the text by header tag section."""
-        for child_node in node.children:
-            if isinstance(child_node, Tag) and h_tag_regex.match(child_node.name):
-                section_name, section_lvl = child_node.get_text(), int(child_node.name[1])
-                sectioned_text[(section_name, section_lvl)].append('')  # placeholder incase there is no text
-                continue
-            if isinstance(child_node, Tag) and child_node.find(h_tag_regex) is None:
-                sectioned_text[(section_name, section_lvl)].append(' '.join(child_node.get_text().split()))
-                continue
-            if isinstance(child_node, NavigableString):
-                if child_node.strip():
-                    sectioned_text[(section_name, section_lvl)].append(' '.join(child_node.strip().split()))
-                continue
-            go_down_html_tree(child_node, section_name, section_lvl)
-
-    soup = BeautifulSoup(html, 'html.parser')
-
-    a: Tag
-    img: Tag
-    for a in soup.find_all('a'):
-        a.replace_with(a.get_text())
-    for img in soup.find_all('img'):
-        img.decompose()
-
-    go_down_html_tree(soup, section_name, section_lvl)
-    return [{'name': ' '.join(name.split()), 'level': lvl, 'text': ' '.join(texts)} for (name, lvl), texts in sectioned_text.items()]
+    h_tag_regex = re.compile(r'^h[1-6]$')
+    preserve_whitespace_tags = {'pre', 'textarea'}
+    string_container_tags = {'script', 'style', 'template'}  # Their strings are left out of `get_text`
+    # Same as the void elements of BeautifulSoup's tree builder
+    void_tags = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+        'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+    }
+
+    class Element:
+        """ An open tag."""
+        __slots__ = ('tag', 'section', 'parts', 'pieces', 'has_header', 'in_link', 'in_pre', 'in_container')
+
+        def __init__(
+            self,
+            tag: str,
+            section: tuple[str, int],
+            in_link: bool,
+            in_pre: bool,
+            in_container: bool,
+        ) -> None:
+            self.tag = tag
+            self.section = section  # section of the next child, changed by h tag children
+            self.parts: list[str] = []  # all of the text in the tag
+            self.pieces: list[tuple[tuple[str, int], str]] = []  # text of each child, used if it has h tag
+            self.has_header = False
+            self.in_link = in_link
+            self.in_pre = in_pre
+            self.in_container = in_container
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.stack = [self.Element('[document]', ('null', 0), False, False, False)]
+        self.data: list[str] = []  # Text not ended by a tag or another kind of string yet
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        self.end_data()
+        if tag == 'img':
+            return
+
+        parent = self.stack[-1]
+        self.stack.append(self.Element(
+            tag,
+            parent.section,
+            parent.in_link or parent.tag == 'a',
+            parent.in_pre or tag in self.preserve_whitespace_tags,
+            parent.in_container or tag in self.string_container_tags,
+        ))
+        if tag in self.void_tags:
+            self.close_element()
+
+    def handle_startendtag(self, tag: str, attrs) -> None:
+        self.handle_starttag(tag, attrs)
+        if tag != 'img' and tag not in self.void_tags:
+            self.close_element()
+
+    def handle_endtag(self, tag: str) -> None:
+        self.end_data()
+        for idx in range(len(self.stack) - 1, 0, -1):
+            if self.stack[idx].tag == tag:
+                while len(self.stack) > idx:
+                    self.close_element()
+                return
+
+    def handle_data(self, data: str) -> None:
+        self.data.append(data)
+
+    def handle_comment(self, data: str) -> None:
+        self.end_data()
+        self.add_string(data, in_text=False)
+
+    def handle_decl(self, decl: str) -> None:
+        self.end_data()
+        self.add_string(decl[len('DOCTYPE '):], in_text=False)
+
+    def handle_pi(self, data: str) -> None:
+        self.end_data()
+        self.add_string(data, in_text=False)
+
+    def unknown_decl(self, data: str) -> None:
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            self.add_string(data[len('CDATA['):], in_text=True)
+        else:
+            self.add_string(data, in_text=False)
+
+    def end_data(self) -> None:
+        if self.data:
+            self.add_string(''.join(self.data), in_text=True)
+            self.data = []
+
+    def add_string(self, data: str, in_text: bool) -> None:
+        """ A string is a piece of text of the current section, and part of the full text of the tag if `in_text`."""
+        element = self.stack[-1]
+        if data.strip():
+            element.pieces.append((element.section, ' '.join(data.split())))
+        elif not element.in_pre:  # BeautifulSoup collapses the whitespace-only strings
+            data = '\n' if '\n' in data else ' '
+
+        if in_text and not element.in_container:
+            element.parts.append(data)
+
+    def close_element(self) -> None:
+        element = self.stack.pop()
+        parent = self.stack[-1]
+        text = ''.join(element.parts)
+        parent.parts.append(text)
+
+        if element.tag == 'a' and not element.in_link:  # a link is replaced by its text
+            if text.strip():
+                parent.pieces.append((parent.section, ' '.join(text.split())))
+        elif self.h_tag_regex.match(element.tag) and not element.in_link:
+            parent.section = (text, int(element.tag[1]))
+            parent.pieces.append((parent.section, ''))  # placeholder incase there is no text
+            parent.has_header = True
+        elif element.has_header:
+            parent.pieces.extend(element.pieces)
+            parent.has_header = True
+        else:
+            parent.pieces.append((parent.section, ' '.join(text.split())))
+
+    def sectioned_text(self) -> list[dict]:
+        self.close()
+        self.end_data()
+        while len(self.stack) > 1:
+            self.close_element()
+
+        sectioned_text = defaultdict(list)
+        for section, piece in self.stack[0].pieces:
+            sectioned_text[section].append(piece)
+
+        return [
+            {'name': ' '.join(name.split()), 'level': lvl, 'text': ' '.join(texts)}
+            for (name, lvl), texts in sectioned_text.items()
+        ]
+
+
+def html_to_sectioned_text(html: str) -> list[dict]:
+    """ Split the text of HTML document by the h tags, see `SectionedTextParser`."""
+    parser = SectionedTextParser()
+    parser.feed(html)
+    return parser.sectioned_text()
+
+
+def markdown_to_sectioned_text(md: str) -> list[dict]:
+    """ Render the Markdown document to HTML and split its text by the h tags, see `SectionedTextParser`."""
+    return html_to_sectioned_text(markdown.markdown(md))